@@ -19,6 +19,9 @@ def create_app(test_config=None):
   from keeper import db
   db.init_app(app)
 
+  from keeper import policy
+  policy.init_app(app)
+
   from keeper import vm
   app.register_blueprint(vm.bp)
 
@@ -31,7 +34,16 @@ def create_app(test_config=None):
   from keeper import assistant
   app.register_blueprint(assistant.bp)
 
+  from keeper import webhook
+  app.register_blueprint(webhook.bp)
+
+  from keeper import reconciler
+  app.register_blueprint(reconciler.bp)
+
   return app
 
 def get_info(key):
-  return current_app.config['SETUP'][key]
\ No newline at end of file
+  return current_app.config['SETUP'][key]
+
+def get_optional_info(key, default=None):
+  return current_app.config.get('SETUP', {}).get(key, default)
\ No newline at end of file
@@ -1,13 +1,13 @@
 from flask import (
-  Blueprint, abort, request, current_app, jsonify, url_for, make_response
+  Blueprint, abort, request, current_app, jsonify, make_response
 )
 
 from keeper.manager import *
+from keeper.dispatch import Dispatcher
 from werkzeug.utils import secure_filename
 import tarfile
-from urllib.parse import urljoin, quote
+from urllib.parse import quote
 import time
-import threading
 
 bp = Blueprint("assistant", __name__, url_prefix="/api/v1")
 
@@ -140,26 +140,11 @@ def release(action):
   category = request.args.get("category", None)
   if not category:
     return abort(400, "Category is required.")
-  project = KeeperManager.resolve_project(operator, release_repo, current_app)
-  project_id = project.project_id
   try:
-    KeeperManager.create_branch(project_id, version_info, release_branch, current_app)
+    release_request = ReleaseRequest(action, operator, release_repo, release_branch, category, version_info, project_name, version)
+    return KeeperManager.release_to_repository(release_request, current_app)
   except KeeperException as ke:
-    current_app.logger.error(ke)
-  try:
-    actions = []
-    md_content = KeeperManager.resolve_action_from_store(category, ".md", current_app, project_name, version)
-    actions.append({"action": action, "file_path": "install.md", "content": md_content})
-    actions.append({"action": action, "file_path": "install.sh", "content": KeeperManager.resolve_action_from_store(category, ".sh", current_app, project_name, version)})
-    email = "%s@inspur.com" %(operator,)
-    history_file_path = "history/release-{}.md".format(version,)
-    KeeperManager.manipulate_file_to_repository(action, project_id, version_info, operator, email, history_file_path, md_content, current_app)
-    KeeperManager.commit_files(project_id, version_info, "Commit files about release: %s" %(version_info,), actions, current_app)
-    return "Successful released version: %s to project: %s with action: %s" %(version, project_name, action)
-  except KeeperException as ke:
-    message = "Failed to commit files to the repository: %s, with error: %s" % (release_repo, ke)
-    current_app.logger.error(message)
-    return abort(400, message)
+    return abort(ke.code, ke.message)
 
 @bp.route("/variables", methods=["POST"])
 def config_variables():
@@ -178,6 +163,7 @@ def config_variables():
   branch = request.args.get("branch", None)
   if not branch:
     branch = "master"
+  dry_run = request.args.get("dry_run", "false").lower() == "true"
   try:
     config_project = KeeperManager.resolve_project(operator, config_repo, current_app)
   except KeeperException as e:
@@ -193,7 +179,9 @@ def config_variables():
     current_app.logger.debug("Config variable from the repository: %s at branch %s with file: %s, operator: %s", config_repo, branch, file_path, operator)
     target_project_id = target_project.project_id
     current_app.logger.debug("Set variable to the repository: %s", target_project.project_name)
-    KeeperManager.resolve_config_variables(config_project_id, target_project_id, file_path, branch, current_app)
+    plan = KeeperManager.resolve_config_variables(config_project_id, target_project_id, file_path, branch, current_app, dry_run=dry_run)
+    if dry_run:
+      return jsonify(plan.to_dict())
     return "Successful resolved config variables to the target repo."
   except KeeperException as e:
     current_app.logger.debug("Failed to handle config variables: %s", e)
@@ -250,7 +238,10 @@ def resolve_pipeline_failed_jobs():
   if not pipeline_id:
     return abort(400, "Pipeline ID is required.")
   try:
+    started_at = time.time()
     pipeline_logs = KeeperManager.get_pipeline_failed_jobs(int(pipeline_project_id), int(pipeline_id), current_app)
+    fetch_seconds = round(time.time() - started_at, 3)
+    current_app.logger.debug("Fetched %d failed job traces of pipeline: %s in %.3f seconds.", len(pipeline_logs), pipeline_id, fetch_seconds)
     issue_label = "devops"
     matched, assignee_info = KeeperManager.match_job_log_by_judgement(pipeline_logs, current_app)
     if matched:
@@ -266,15 +257,9 @@ def resolve_pipeline_failed_jobs():
       }
     base_username = base_project_name[:base_project_name.index("/")]
     current_app.logger.debug("Resolved username: %s from base project name: %s", base_username, base_project_name)
-    open_issue_url = urljoin("http://localhost:5000", url_for("integration.issue_assign", username=base_username, project_name=base_project_name))
-    current = current_app._get_current_object()
-    def callback():
-      issue_title = assignee_info["title"]
-      issue_description = assignee_info["description"]
-      resp = requests.post(open_issue_url, json={"title": issue_title, "description": issue_description, "label": ",".join([issue_label, "todo"])})
-      current.logger.debug("Requested URL: %s with status code: %d, response text: %s" % (open_issue_url, resp.status_code, resp.text))
-    threading.Thread(target=callback).start()
-    return jsonify(message="Successful resolved pipeline failed jobs.")
+    issue_request = IssueRequest(base_username, base_project_name, assignee_info["title"], assignee_info["description"], ",".join([issue_label, "todo"]))
+    Dispatcher.submit(current_app, KeeperManager.assign_issue, issue_request, current_app._get_current_object())
+    return jsonify(message="Successful resolved pipeline failed jobs.", failed_jobs=len(pipeline_logs), fetch_seconds=fetch_seconds)
   except KeeperException as e:
     current_app.logger.error("Failed to resolve artifacts: %s", e)
     return abort(e.code, e.message)
@@ -309,6 +294,39 @@ def evaluate_content():
     current_app.logger.error("Failed to evaluate content for file: %s with error: %s", file_path, e)
     return abort(e.code, e.message)
 
+@bp.route("/contents/evaluate/batch", methods=["POST"])
+def evaluate_contents():
+  category = request.args.get("category", None)
+  if not category:
+    return abort(400, "Category is required.")
+  username = request.args.get("username", None)
+  if not username:
+    return abort(400, "Username is required.")
+  project_name = request.args.get("project_name", None)
+  if not project_name:
+    return abort(400, "Project name is required.")
+  branch = request.args.get("branch", None)
+  if not branch:
+    branch = "master"
+  tree_prefix = request.args.get("tree_prefix", None)
+  data = request.get_json(silent=True) or {}
+  file_paths = data.get("file_paths", [])
+  if not file_paths and tree_prefix is None:
+    return abort(400, "File paths or tree prefix is required.")
+  try:
+    project = KeeperManager.resolve_project(username, project_name, current_app)
+    if tree_prefix is not None:
+      file_paths = file_paths + [t["path"] for t in KeeperManager.get_repository_tree(project.project_id, tree_prefix, branch, current_app) if t["type"] == "blob"]
+    max_files = KeeperManager.get_evaluation_conf()["MAX_FILES"]
+    if len(file_paths) > max_files:
+      return abort(400, "Too many files to evaluate: %d, the limit is %d." % (len(file_paths), max_files))
+    results = KeeperManager.evaluate_files(project.project_id, category, file_paths, branch, current_app)
+    action_required = any(r.get("level", 0) >= 3 for r in results)
+    status_code = 412 if action_required else 200
+    return make_response(jsonify(category=category, action_required=action_required, results=results), status_code)
+  except KeeperException as e:
+    current_app.logger.error("Failed to evaluate contents of project: %s with error: %s", project_name, e)
+    return abort(e.code, e.message)
 
 @bp.route("/jobs/judgement", methods=["POST", "DELETE"])
 def create_or_update_job_log_judgement():
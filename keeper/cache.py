@@ -0,0 +1,94 @@
+import threading
+import time
+from collections import OrderedDict
+
+from keeper import get_optional_info
+
+class TTLCache:
+  registry = {}
+  lock = threading.Lock()
+  missing = object()
+
+  def __init__(self, name, maxsize=1024, ttl=300, negative_ttl=None, maxbytes=0):
+    self.name = name
+    self.maxsize = maxsize
+    self.maxbytes = maxbytes
+    self.bytes = 0
+    self.ttl = ttl
+    self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+    self.entries = OrderedDict()
+    self.entries_lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  @classmethod
+  def named(cls, name, **defaults):
+    with cls.lock:
+      if name not in cls.registry:
+        conf = dict(defaults)
+        for key, val in get_optional_info("CACHE_CONF", {}).get(name.upper(), {}).items():
+          conf[key.lower()] = val
+        cls.registry[name] = cls(name, **conf)
+      return cls.registry[name]
+
+  @classmethod
+  def stats_all(cls):
+    with cls.lock:
+      caches = list(cls.registry.values())
+    return {c.name: c.stats() for c in caches}
+
+  def get(self, key, default=None):
+    with self.entries_lock:
+      entry = self.entries.get(key)
+      if entry is not None and entry[1] < time.time():
+        self._remove(key)
+        entry = None
+      if entry is None:
+        self.misses += 1
+        return default
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return entry[0]
+
+  def set(self, key, value, ttl=None, size=0):
+    expires_at = time.time() + (self.ttl if ttl is None else ttl)
+    with self.entries_lock:
+      self._remove(key)
+      self.entries[key] = (value, expires_at, size)
+      self.bytes += size
+      while self.entries and (len(self.entries) > self.maxsize or (self.maxbytes > 0 and self.bytes > self.maxbytes)):
+        self._remove(next(iter(self.entries)))
+        self.evictions += 1
+
+  def _remove(self, key):
+    entry = self.entries.pop(key, None)
+    if entry is not None:
+      self.bytes -= entry[2]
+
+  def invalidate(self, key):
+    with self.entries_lock:
+      self._remove(key)
+
+  def invalidate_if(self, predicate):
+    with self.entries_lock:
+      for key in [k for k in self.entries if predicate(k)]:
+        self._remove(key)
+
+  def clear(self):
+    with self.entries_lock:
+      self.entries.clear()
+      self.bytes = 0
+
+  def stats(self):
+    with self.entries_lock:
+      return {
+        "size": len(self.entries),
+        "maxsize": self.maxsize,
+        "bytes": self.bytes,
+        "maxbytes": self.maxbytes,
+        "ttl": self.ttl,
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions,
+      }
@@ -0,0 +1,188 @@
+import hashlib
+import inspect
+import json
+import re
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from keeper import get_optional_info
+from keeper.cache import TTLCache
+from keeper.ratelimit import RateLimiter
+
+class CachedResponse:
+  # Parsed JSON is memoized and shared between callers, treat it as read-only.
+  def __init__(self, resp):
+    self.status_code = resp.status_code
+    self.headers = resp.headers
+    self.url = resp.url
+    self.content = resp.content
+    self.encoding = resp.encoding
+    self.links = resp.links
+    self.parsed = None
+
+  @property
+  def text(self):
+    return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+  def json(self):
+    if self.parsed is None:
+      self.parsed = json.loads(self.text)
+    return self.parsed
+
+  def close(self):
+    pass
+
+class HTTPClient:
+  idempotent_methods = frozenset(["HEAD", "GET", "PUT", "DELETE", "OPTIONS"])
+  retry_status_codes = (502, 503, 504)
+  # File bodies are cached by ContentCache, keeping them here as well would double the memory.
+  etag_excluded_paths = re.compile(r"/repository/files/.+/raw|/repository/blobs/")
+  default_conf = {
+    "POOL_CONNECTIONS": 4,
+    "POOL_MAXSIZE": 16,
+    "CONNECT_TIMEOUT": 5,
+    "READ_TIMEOUT": 60,
+    "RETRIES": 3,
+    "BACKOFF_FACTOR": 0.5,
+  }
+  sessions = {}
+  lock = threading.Lock()
+  counters = {"revalidated": 0, "not_modified": 0, "stored": 0}
+
+  @classmethod
+  def get_conf(cls):
+    conf = dict(cls.default_conf)
+    conf.update(get_optional_info("HTTP_CONF", {}))
+    return conf
+
+  @classmethod
+  def _get_session(cls, url):
+    parts = urlsplit(url)
+    host = "%s://%s" % (parts.scheme, parts.netloc)
+    with cls.lock:
+      if host not in cls.sessions:
+        conf = cls.get_conf()
+        # Retry-After is left to RateLimiter.observe, otherwise urllib3 would sleep through 429s
+        # itself and the limiter could never pause the other callers of that token.
+        retry = Retry(total=conf["RETRIES"], backoff_factor=conf["BACKOFF_FACTOR"],
+          status_forcelist=cls.retry_status_codes, raise_on_status=False, respect_retry_after_header=False,
+          **{cls._get_retry_methods_arg(): cls.idempotent_methods})
+        adapter = HTTPAdapter(pool_connections=conf["POOL_CONNECTIONS"],
+          pool_maxsize=conf["POOL_MAXSIZE"], max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        cls.sessions[host] = (session, (conf["CONNECT_TIMEOUT"], conf["READ_TIMEOUT"]))
+      return cls.sessions[host]
+
+  @staticmethod
+  def _get_retry_methods_arg():
+    # urllib3 renamed method_whitelist to allowed_methods in 1.26, the lock pins 1.24.
+    if "allowed_methods" in inspect.signature(Retry.__init__).parameters:
+      return "allowed_methods"
+    return "method_whitelist"
+
+  @classmethod
+  def _send(cls, session, method, url, priority, **kwargs):
+    host = urlsplit(url).netloc
+    principal = cls._get_principal(kwargs)
+    retries = RateLimiter.get_conf()["MAX_RETRIES"]
+    while True:
+      RateLimiter.acquire(host, principal, priority)
+      resp = session.request(method, url, **kwargs)
+      if not RateLimiter.observe(host, principal, resp) or retries <= 0:
+        return resp
+      # Rate limited: queue the call again behind the pause instead of failing it.
+      retries -= 1
+      resp.close()
+
+  @classmethod
+  def request(cls, method, url, revalidate=False, priority=RateLimiter.normal_priority, **kwargs):
+    session, timeout = cls._get_session(url)
+    kwargs.setdefault("timeout", timeout)
+    if not revalidate or method != "GET" or kwargs.get("stream"):
+      return cls._send(session, method, url, priority, **kwargs)
+    ttl = cls._get_endpoint_ttl(url)
+    if ttl == 0 or cls.etag_excluded_paths.search(urlsplit(url).path):
+      return cls._send(session, method, url, priority, **kwargs)
+    store = cls.get_etag_store()
+    key = cls._get_cache_key(url, kwargs)
+    cached = store.get(key)
+    if cached is not None:
+      kwargs["headers"] = dict(kwargs.get("headers") or {}, **{"If-None-Match": cached.headers["ETag"]})
+      cls._count("revalidated")
+    resp = cls._send(session, method, url, priority, **kwargs)
+    if resp.status_code == 304 and cached is not None:
+      cls._count("not_modified")
+      store.set(key, cached, ttl=ttl, size=len(cached.content))
+      return cached
+    if resp.status_code == 200 and resp.headers.get("ETag"):
+      cached = CachedResponse(resp)
+      cls._count("stored")
+      store.set(key, cached, ttl=ttl, size=len(cached.content))
+      return cached
+    return resp
+
+  @classmethod
+  def get_etag_store(cls):
+    return TTLCache.named("etag", maxsize=512, ttl=600, maxbytes=16 * 1024 * 1024)
+
+  @classmethod
+  def _get_endpoint_ttl(cls, url):
+    path = urlsplit(url).path
+    for pattern, ttl in cls.get_conf().get("ETAG_ENDPOINT_TTL", {}).items():
+      if re.search(pattern, path):
+        return ttl
+    return None
+
+  @classmethod
+  def _get_principal(cls, kwargs):
+    headers = kwargs.get("headers") or {}
+    principal = headers.get("PRIVATE-TOKEN")
+    if not principal and kwargs.get("auth"):
+      principal = repr(getattr(kwargs["auth"], "username", kwargs["auth"]))
+    if not principal:
+      return None
+    return hashlib.sha256(principal.encode("utf-8")).hexdigest()
+
+  @classmethod
+  def _get_cache_key(cls, url, kwargs):
+    params = sorted((k, repr(v)) for k, v in (kwargs.get("params") or {}).items())
+    return url, tuple(params), cls._get_principal(kwargs)
+
+  @classmethod
+  def _count(cls, name):
+    with cls.lock:
+      cls.counters[name] += 1
+
+  @classmethod
+  def stats(cls):
+    with cls.lock:
+      return dict(cls.counters)
+
+  @classmethod
+  def get(cls, url, **kwargs):
+    return cls.request("GET", url, **kwargs)
+
+  @classmethod
+  def post(cls, url, **kwargs):
+    return cls.request("POST", url, **kwargs)
+
+  @classmethod
+  def put(cls, url, **kwargs):
+    return cls.request("PUT", url, **kwargs)
+
+  @classmethod
+  def delete(cls, url, **kwargs):
+    return cls.request("DELETE", url, **kwargs)
+
+  @classmethod
+  def close(cls):
+    with cls.lock:
+      for session, _ in cls.sessions.values():
+        session.close()
+      cls.sessions.clear()
@@ -0,0 +1,122 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from keeper import get_optional_info
+
+class ContentCache:
+  lock = threading.Lock()
+  conf = None
+  memory = OrderedDict()
+  memory_bytes = 0
+  disk_bytes = 0
+  stats_counter = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+  @classmethod
+  def _ensure_configured(cls, app):
+    if cls.conf is not None:
+      return cls.conf
+    with cls.lock:
+      if cls.conf is None:
+        conf = {
+          "MEMORY_BYTES": 32 * 1024 * 1024,
+          "DISK_BYTES": 256 * 1024 * 1024,
+          "PATH": os.path.join(app.instance_path, "content-cache"),
+        }
+        conf.update(get_optional_info("CONTENT_CACHE_CONF", {}))
+        try:
+          os.makedirs(conf["PATH"])
+        except OSError:
+          pass
+        cls.disk_bytes = sum(e.stat().st_size for e in os.scandir(conf["PATH"]) if e.is_file())
+        cls.conf = conf
+    return cls.conf
+
+  @classmethod
+  def _disk_path(cls, key):
+    digest = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+    return os.path.join(cls.conf["PATH"], digest)
+
+  @classmethod
+  def get(cls, key, app):
+    cls._ensure_configured(app)
+    with cls.lock:
+      if key in cls.memory:
+        cls.memory.move_to_end(key)
+        cls.stats_counter["memory_hits"] += 1
+        return cls.memory[key].decode("utf-8")
+    path = cls._disk_path(key)
+    try:
+      with open(path, "rb") as f:
+        data = f.read()
+      os.utime(path)
+    except OSError:
+      with cls.lock:
+        cls.stats_counter["misses"] += 1
+      return None
+    with cls.lock:
+      cls.stats_counter["disk_hits"] += 1
+      cls._remember(key, data)
+    return data.decode("utf-8")
+
+  @classmethod
+  def set(cls, key, content, app):
+    conf = cls._ensure_configured(app)
+    data = content.encode("utf-8")
+    with cls.lock:
+      cls._remember(key, data)
+    if len(data) > conf["DISK_BYTES"]:
+      return
+    path = cls._disk_path(key)
+    tmp_path = "%s.%d.tmp" % (path, threading.get_ident())
+    try:
+      with open(tmp_path, "wb") as f:
+        f.write(data)
+      existed = os.path.exists(path)
+      os.replace(tmp_path, path)
+    except OSError as e:
+      app.logger.error("Failed to write content cache file: %s with error: %s", path, e)
+      return
+    with cls.lock:
+      if not existed:
+        cls.disk_bytes += len(data)
+      if cls.disk_bytes > conf["DISK_BYTES"]:
+        cls._evict_disk(conf)
+
+  @classmethod
+  def _remember(cls, key, data):
+    if key in cls.memory:
+      cls.memory_bytes -= len(cls.memory.pop(key))
+    if len(data) > cls.conf["MEMORY_BYTES"]:
+      return
+    cls.memory[key] = data
+    cls.memory_bytes += len(data)
+    while cls.memory_bytes > cls.conf["MEMORY_BYTES"]:
+      _, evicted = cls.memory.popitem(last=False)
+      cls.memory_bytes -= len(evicted)
+      cls.stats_counter["evictions"] += 1
+
+  @classmethod
+  def _evict_disk(cls, conf):
+    entries = sorted((e for e in os.scandir(conf["PATH"]) if e.is_file() and not e.name.endswith(".tmp")),
+      key=lambda e: e.stat().st_mtime)
+    total = sum(e.stat().st_size for e in entries)
+    for e in entries:
+      if total <= conf["DISK_BYTES"] * 0.9:
+        break
+      try:
+        size = e.stat().st_size
+        os.remove(e.path)
+        total -= size
+        cls.stats_counter["evictions"] += 1
+      except OSError:
+        pass
+    cls.disk_bytes = total
+
+  @classmethod
+  def stats(cls):
+    with cls.lock:
+      stats = dict(cls.stats_counter)
+      stats.update(memory_entries=len(cls.memory), memory_bytes=cls.memory_bytes, disk_bytes=cls.disk_bytes)
+      return stats
@@ -46,6 +46,16 @@ def get_user_token_by_project(project_id):
     '''select u.token as token from user u join user_project up on u.user_id = up.user_id where up.project_id = ?''', (project_id,)
   ).fetchone()
 
+def get_user_tokens():
+  return get_db().execute(
+    '''select user_id, username, token from user'''
+  ).fetchall()
+
+def get_project_tokens():
+  return get_db().execute(
+    '''select up.project_id as project_id, u.token as token from user u join user_project up on u.user_id = up.user_id'''
+  ).fetchall()
+
 def get_user_by_id(user_id):
   return get_db().execute(
     '''select user_id, username, token from user where user_id = ?''', (user_id,)
@@ -164,10 +174,187 @@ def get_note_template(name):
 
 def get_available_ip():
   return get_db().execute(
-    '''select ip.id, ip.ip_address
-          from ip_provision ip 
-         left join ip_runner ir on ir.ip_provision_id = ip.id
-         where  ip.is_allocated = 0'''
+    '''select id, ip_address
+          from ip_provision
+         where is_allocated = 0
+         limit 1'''
+  ).fetchone()
+
+def count_available_ips():
+  return get_db().execute('select count(*) from ip_provision where is_allocated = 0').fetchone()[0]
+
+def begin_immediate(c):
+  # Committing or rolling back here would end a caller's unrelated pending work, so refuse it.
+  if c.in_transaction:
+    raise KeeperException(500, "Cannot take the IP provision write lock inside an open transaction.")
+  c.execute('begin immediate')
+
+def select_reserved_runner(c, project_id):
+  return c.execute(
+    '''select ip_provision_id, project_id, runner_id, pipeline_id, is_power_on, is_canceled
+          from ip_runner
+         where project_id = ?''', (project_id,)
+  ).fetchone()
+
+def select_host_loads(c):
+  return {r["host_name"]: r for r in c.execute(
+    '''select host_name, count(*) as vms, sum(vm_memory) as memory
+          from ip_provision
+         where is_allocated = 1 and host_name is not null
+         group by host_name'''
+  ).fetchall()}
+
+def get_host_loads():
+  return select_host_loads(get_db())
+
+def select_free_ip(c, rank=None):
+  if rank is None:
+    return c.execute(
+      '''select id, ip_address, host_name
+            from ip_provision
+           where is_allocated = 0
+           limit 1'''
+    ).fetchone()
+  # Loads are read under the write lock, so concurrent claims see each other and cannot overshoot host limits.
+  for host_name in rank(select_host_loads(c)):
+    ip = c.execute(
+      '''select id, ip_address, host_name
+            from ip_provision
+           where host_name = ? and is_allocated = 0
+           limit 1''', (host_name,)
+    ).fetchone()
+    if ip:
+      return ip
+  return None
+
+def allocate_ip_provision(project_id, pipeline_id, vm_memory, app, rank=None):
+  c = get_db()
+  try:
+    # Take the write lock up front so the reservation check, the claim and the
+    # ip_runner insert cannot interleave with another worker or process.
+    begin_immediate(c)
+    reserved = select_reserved_runner(c, project_id)
+    if reserved:
+      c.rollback()
+      return reserved, None
+    ip = select_free_ip(c, rank)
+    if not ip:
+      c.rollback()
+      return None, None
+    c.execute('update ip_provision set is_allocated = 1, vm_memory = ? where id = ? and is_allocated = 0', (vm_memory, ip["id"]))
+    c.execute('insert into ip_runner (ip_provision_id, pipeline_id, project_id) values (?, ?, ?)', (ip["id"], pipeline_id, project_id))
+    c.commit()
+    return None, ip
+  except sqlite3.Error as e:
+    app.logger.error("Failed to allocate IP provision: %s", e)
+    c.rollback()
+    raise KeeperException(500, e)
+
+def claim_warm_vm_ip(vm_dir, vm_box, vm_memory, created_at, app, rank=None):
+  c = get_db()
+  try:
+    begin_immediate(c)
+    ip = select_free_ip(c, rank)
+    if not ip:
+      c.rollback()
+      return None
+    c.execute('update ip_provision set is_allocated = 1, vm_memory = ? where id = ? and is_allocated = 0', (vm_memory, ip["id"]))
+    c.execute('insert into warm_vm (vm_dir, vm_box, vm_memory, ip_provision_id, created_at) values (?, ?, ?, ?, ?)',
+      (vm_dir, vm_box, vm_memory, ip["id"], created_at))
+    c.commit()
+    return ip
+  except sqlite3.Error as e:
+    app.logger.error("Failed to claim IP provision for warm VM: %s", e)
+    c.rollback()
+    raise KeeperException(500, e)
+
+def assign_warm_vm(vm_box, vm_memory, project_id, pipeline_id, alias, assigned_at, app):
+  c = get_db()
+  try:
+    begin_immediate(c)
+    reserved = select_reserved_runner(c, project_id)
+    if reserved:
+      c.rollback()
+      return reserved, None
+    warm_vm = c.execute(
+      '''select wv.id, wv.vm_dir, wv.ip_provision_id, wv.ready_at, ip.ip_address
+            from warm_vm wv
+            left join ip_provision ip on ip.id = wv.ip_provision_id
+           where wv.vm_box = ? and wv.vm_memory = ? and wv.status = 1
+           order by wv.ready_at
+           limit 1''', (vm_box, vm_memory)
+    ).fetchone()
+    if not warm_vm:
+      c.rollback()
+      return None, None
+    c.execute('update warm_vm set status = 2, alias = ?, pipeline_id = ?, assigned_at = ? where id = ?',
+      (alias, pipeline_id, assigned_at, warm_vm["id"]))
+    c.execute('insert into ip_runner (ip_provision_id, pipeline_id, project_id) values (?, ?, ?)',
+      (warm_vm["ip_provision_id"], pipeline_id, project_id))
+    c.commit()
+    return None, warm_vm
+  except sqlite3.Error as e:
+    app.logger.error("Failed to assign warm VM: %s", e)
+    c.rollback()
+    raise KeeperException(500, e)
+
+def update_warm_vm_ready(vm_dir, ready_at, snapshot_name, app):
+  proxied_execute(app, 'update warm_vm set status = 1, ready_at = ?, snapshot_name = ? where vm_dir = ? and status = 0', (ready_at, snapshot_name, vm_dir))
+
+def adopt_warm_vm(vm_dir, vm_box, vm_memory, ip_provision_id, alias, pipeline_id, snapshot_name, now, app):
+  proxied_execute(app, '''
+    insert into warm_vm (vm_dir, vm_box, vm_memory, ip_provision_id, status, alias, pipeline_id, created_at, ready_at, assigned_at, snapshot_name)
+      values (?, ?, ?, ?, 2, ?, ?, ?, ?, ?, ?)
+  ''', (vm_dir, vm_box, vm_memory, ip_provision_id, alias, pipeline_id, now, now, now, snapshot_name))
+
+def return_warm_vm(alias, ready_at, app):
+  def t_callback():
+    proxied_execute(app, 'delete from ip_runner where ip_provision_id in (select ip_provision_id from warm_vm where alias = ?)', (alias,))
+    proxied_execute(app, '''
+      update warm_vm set status = 1, alias = null, pipeline_id = null, assigned_at = null, ready_at = ?
+        where alias = ?
+    ''', (ready_at, alias))
+  DBT.execute(app, t_callback)
+
+def discard_warm_vm_by_alias(alias, app):
+  def t_callback():
+    proxied_execute(app, 'update ip_provision set is_allocated = 0 where id in (select ip_provision_id from warm_vm where alias = ?)', (alias,))
+    proxied_execute(app, 'delete from ip_runner where ip_provision_id in (select ip_provision_id from warm_vm where alias = ?)', (alias,))
+    proxied_execute(app, 'delete from warm_vm where alias = ?', (alias,))
+  DBT.execute(app, t_callback)
+
+def get_warm_vm_by_alias(alias):
+  return get_db().execute(
+    '''select vm_dir, vm_box, vm_memory, ip_provision_id, status, pipeline_id, snapshot_name
+          from warm_vm
+         where alias = ?''', (alias,)
+  ).fetchone()
+
+def count_ready_warm_vms(vm_box, vm_memory):
+  return get_db().execute('select count(*) from warm_vm where status = 1 and vm_box = ? and vm_memory = ?',
+    (vm_box, vm_memory)).fetchone()[0]
+
+def release_warm_vm(vm_dir, app):
+  def t_callback():
+    proxied_execute(app, '''
+      update ip_provision set is_allocated = 0
+        where id in (select ip_provision_id from warm_vm where vm_dir = ? and status != 2)
+    ''', (vm_dir,))
+    proxied_execute(app, 'delete from warm_vm where vm_dir = ?', (vm_dir,))
+  DBT.execute(app, t_callback)
+
+def remove_warm_vm_by_alias(alias, app):
+  proxied_execute(app, 'delete from warm_vm where alias = ?', (alias,))
+
+def get_warm_vm_dir(alias):
+  r = get_db().execute('select vm_dir from warm_vm where alias = ?', (alias,)).fetchone()
+  return r["vm_dir"] if r else None
+
+def get_warm_vms():
+  return get_db().execute(
+    '''select wv.vm_dir, wv.vm_box, wv.vm_memory, wv.status, wv.alias, wv.pipeline_id, wv.created_at, wv.ready_at, wv.snapshot_name, ip.ip_address
+          from warm_vm wv
+          left join ip_provision ip on ip.id = wv.ip_provision_id'''
   ).fetchall()
 
 def get_reserved_runner_by_project(project_id):
@@ -203,14 +390,15 @@ def get_ip_provison_dead_lock(project_id):
 	).fetchone()
 
 def proxied_execute(app, sql, *data):
-  if "CONN" in app.config and app.config["CONN"]:
-    c = app.config["CONN"]
-    c.execute(sql, *data)
+  if g.get("dbt_conn") is not None:
+    c = g.dbt_conn
+    return c.execute(sql, *data)
   else:
     c = get_db()
     try:
-      c.execute(sql, *data)
+      cursor = c.execute(sql, *data)
       c.commit()
+      return cursor
     except Exception as e:
       app.logger.error(e)
       c.rollback()
@@ -313,6 +501,11 @@ def get_job_log_judgement(rule_name, app):
     select rule_name, rule from job_log_judgement where rule_name = ?
   ''', (rule_name,)).fetchone()
 
+def get_job_log_judgements(app):
+  return get_db().execute('''
+    select rule_name, rule from job_log_judgement
+  ''').fetchall()
+
 def get_evaluation(category, app):
   return get_db().execute('''
     select category, standard, level, suggestion from evaluation where category = ?
@@ -330,38 +523,219 @@ def insert_evaluation(category, standard, level, suggestion, app):
 def delete_evaluation(category, app):
   return proxied_execute(app, 'delete from evaluation where category = ?', (category,))
 
-class DBT:
-  conn = None
-  @classmethod
-  def __get_conn(cls, app):
-    cls.conn = get_db()
-    app.config["CONN"] = cls.conn
+def insert_webhook_event(endpoint, path, query_string, payload, created_at, app):
+  return proxied_execute(app, 'insert into webhook_event (endpoint, path, query_string, payload, created_at) values (?, ?, ?, ?, ?)',
+    (endpoint, path, query_string, payload, created_at)).lastrowid
 
-  @classmethod
-  def __commit(cls):
-    cls.conn.commit()
+def lease_webhook_event(lease_token, now, leased_until, app):
+  proxied_execute(app, '''
+    update webhook_event set status = 1, lease_token = ?, leased_until = ?, started_at = ?, attempts = attempts + 1
+      where id = (
+        select id from webhook_event
+          where status = 0 or (status = 1 and leased_until < ?)
+          order by id limit 1)
+  ''', (lease_token, leased_until, now, now))
+  return get_db().execute('''
+    select id, endpoint, path, query_string, payload, attempts, created_at, started_at from webhook_event
+      where lease_token = ? and status = 1
+  ''', (lease_token,)).fetchone()
+
+def fail_expired_webhook_events(now, max_attempts, app):
+  return proxied_execute(app, '''
+    update webhook_event set status = 3, finished_at = ?, lease_token = null,
+        last_error = 'Lease expired after ' || attempts || ' attempts, the handler never finished.'
+      where status = 1 and leased_until < ? and attempts >= ?
+  ''', (now, now, max_attempts)).rowcount
+
+def finish_webhook_event(event_id, lease_token, status, finished_at, last_error, app):
+  proxied_execute(app, '''
+    update webhook_event set status = ?, finished_at = ?, last_error = ?, lease_token = null
+      where id = ? and lease_token = ?
+  ''', (status, finished_at, last_error, event_id, lease_token))
 
-  @classmethod
-  def __rollback(cls):
-    cls.conn.rollback()
+def requeue_webhook_event(event_id, lease_token, last_error, app):
+  proxied_execute(app, '''
+    update webhook_event set status = 0, last_error = ?, lease_token = null, leased_until = null
+      where id = ? and lease_token = ?
+  ''', (last_error, event_id, lease_token))
+
+def delete_webhook_events_before(finished_at, app):
+  proxied_execute(app, 'delete from webhook_event where status in (2, 3) and finished_at < ?', (finished_at,))
+
+def get_webhook_queue_stats():
+  return get_db().execute('''
+    select sum(case when status = 0 then 1 else 0 end) as queued,
+           sum(case when status = 1 then 1 else 0 end) as leased,
+           sum(case when status = 3 then 1 else 0 end) as failed,
+           min(case when status in (0, 1) then created_at end) as oldest_created_at
+      from webhook_event
+  ''').fetchone()
+
+def get_project_priorities():
+  return get_db().execute('select project_id, priority from project').fetchall()
+
+def enqueue_pipeline(pipeline_id, project_id, priority, enqueued_at, app):
+  return proxied_execute(app, 'insert or ignore into pipeline_queue (pipeline_id, project_id, priority, enqueued_at) values (?, ?, ?, ?)',
+    (pipeline_id, project_id, priority, enqueued_at)).rowcount
+
+def get_visible_pipelines(now):
+  return get_db().execute('''
+    select pipeline_id, project_id, priority, enqueued_at, attempts from pipeline_queue
+      where (leased_until is null or leased_until < ?)
+        and project_id not in (select project_id from ip_runner)
+  ''', (now,)).fetchall()
+
+def lease_pipeline(pipeline_id, lease_token, now, leased_until, app):
+  return proxied_execute(app, '''
+    update pipeline_queue set lease_token = ?, leased_until = ?, attempts = attempts + 1
+      where pipeline_id = ? and (leased_until is null or leased_until < ?)
+  ''', (lease_token, leased_until, pipeline_id, now)).rowcount
+
+def get_running_pipeline_counts():
+  return get_db().execute(
+    '''select project_id, count(*) as running
+          from ip_runner
+         group by project_id'''
+  ).fetchall()
+
+def ack_pipeline(pipeline_id, lease_token, app):
+  proxied_execute(app, 'delete from pipeline_queue where pipeline_id = ? and lease_token = ?', (pipeline_id, lease_token))
+
+def release_pipeline(pipeline_id, lease_token, app):
+  proxied_execute(app, '''
+    update pipeline_queue set lease_token = null, leased_until = null
+      where pipeline_id = ? and lease_token = ?
+  ''', (pipeline_id, lease_token))
+
+def remove_pipeline(pipeline_id, app):
+  proxied_execute(app, 'delete from pipeline_queue where pipeline_id = ?', (pipeline_id,))
 
+def get_queued_pipelines():
+  return get_db().execute('''
+    select pipeline_id, project_id, priority, enqueued_at, lease_token, leased_until, attempts from pipeline_queue
+      order by priority, enqueued_at, pipeline_id
+  ''').fetchall()
+
+def upsert_host_ip_provisions(host_name, ip_addresses, app):
+  def t_callback():
+    for ip_address in ip_addresses:
+      proxied_execute(app, 'insert or ignore into ip_provision (ip_address) values (?)', (ip_address,))
+      proxied_execute(app, 'update ip_provision set host_name = ? where ip_address = ?', (host_name, ip_address))
+  DBT.execute(app, t_callback)
+
+def get_host_name_by_ip(ip_address):
+  r = get_db().execute('select host_name from ip_provision where ip_address = ?', (ip_address,)).fetchone()
+  return r["host_name"] if r else None
+
+def insert_vm_host(vm_dir, host_name, vm_memory, app):
+  proxied_execute(app, 'insert or replace into vm_host (vm_dir, host_name, vm_memory) values (?, ?, ?)', (vm_dir, host_name, vm_memory))
+
+def remove_vm_host(vm_dir, app):
+  proxied_execute(app, 'delete from vm_host where vm_dir = ?', (vm_dir,))
+
+def get_vm_host_name(vm_dir):
+  r = get_db().execute('select host_name from vm_host where vm_dir = ?', (vm_dir,)).fetchone()
+  return r["host_name"] if r else None
+
+def get_vm_inventory(project_id=None, power_status=None, cancel_status=None, host_name=None, limit=50, offset=0):
+  conditions = []
+  params = []
+  if project_id is not None:
+    conditions.append("pr.project_id = ?")
+    params.append(project_id)
+  if power_status is not None:
+    conditions.append("ir.is_power_on = ?")
+    params.append(power_status)
+  if cancel_status is not None:
+    conditions.append("ir.is_canceled = ?")
+    params.append(cancel_status)
+  if host_name is not None:
+    conditions.append("vh.host_name = ?")
+    params.append(host_name)
+  where = "where %s" % " and ".join(conditions) if conditions else ""
+  return get_db().execute(
+    '''select count(*) over () as total, v.vm_id, v.vm_name, v.target, coalesce(wv.vm_dir, v.vm_name) as vm_dir,
+              pr.project_id, p.project_name, r.runner_id, r.runner_name, ir.pipeline_id, ir.is_power_on, ir.is_canceled,
+              ip.ip_address, vh.host_name, vh.vm_memory, wv.status as warm_status
+          from vm v
+          left join project_runner pr on pr.vm_id = v.vm_id
+          left join project p on p.project_id = pr.project_id
+          left join runner r on r.runner_id = pr.runner_id
+          left join ip_runner ir on ir.runner_id = pr.runner_id
+          left join ip_provision ip on ip.id = ir.ip_provision_id
+          left join warm_vm wv on wv.alias = v.vm_name
+          left join vm_host vh on vh.vm_dir = coalesce(wv.vm_dir, v.vm_name)
+          %s
+         order by v.id
+         limit ? offset ?''' % (where,), params + [limit, offset]
+  ).fetchall()
+
+def get_ip_runners():
+  return get_db().execute(
+    '''select ir.ip_provision_id, ir.project_id, ir.runner_id, ir.pipeline_id, ir.is_power_on, ir.is_canceled,
+              ip.ip_address, ip.host_name, r.runner_name
+          from ip_runner ir
+          left join ip_provision ip on ip.id = ir.ip_provision_id
+          left join runner r on r.runner_id = ir.runner_id
+         where ir.pipeline_id not in (select pipeline_id from pipeline_queue)'''
+  ).fetchall()
+
+def get_orphan_ip_provisions():
+  return get_db().execute(
+    '''select ip.id, ip.ip_address, ip.host_name
+          from ip_provision ip
+         where ip.is_allocated = 1
+           and not exists (select 1 from ip_runner ir where ir.ip_provision_id = ip.id)
+           and not exists (select 1 from warm_vm wv where wv.ip_provision_id = ip.id)'''
+  ).fetchall()
+
+def release_orphan_ip_provision(ip_provision_id, app):
+  return proxied_execute(app,
+    '''update ip_provision set is_allocated = 0
+        where id = ? and is_allocated = 1
+          and not exists (select 1 from ip_runner where ip_provision_id = ?)
+          and not exists (select 1 from warm_vm where ip_provision_id = ?)''',
+    (ip_provision_id, ip_provision_id, ip_provision_id)).rowcount
+
+def get_runner_projects():
+  return get_db().execute(
+    '''select project_id from project where runner_token is not null
+        union select project_id from project_runner
+        union select project_id from ip_runner'''
+  ).fetchall()
+
+def get_known_runner_ids():
+  return [r["runner_id"] for r in get_db().execute('select runner_id from runner').fetchall()]
+
+def get_known_vm_names():
+  return [r["name"] for r in get_db().execute(
+    '''select vm_name as name from vm
+        union select vm_dir from warm_vm
+        union select alias from warm_vm where alias is not null
+        union select vm_dir from vm_host'''
+  ).fetchall()]
+
+class DBT:
+  # The transaction connection lives in the app context of the calling thread, so
+  # background workers never write through a request thread's open transaction.
   @classmethod
-  def __close(cls):
-    cls.conn.close()
-  
+  def __get_conn(cls):
+    g.dbt_conn = get_db()
+    return g.dbt_conn
+
   @classmethod
-  def __reset(cls, app):
-    app.config["CONN"] = None
+  def __reset(cls):
+    g.pop("dbt_conn", None)
 
   @classmethod
   def execute(cls, app, callback):
+    conn = cls.__get_conn()
     try:
-      cls.__get_conn(app)
-      app.logger.debug("Obtained DB connect from app.config['CONN'], will be running in transaction ...")
+      app.logger.debug("Obtained DB connect of current app context, will be running in transaction ...")
       callback()
-      cls.__commit()
+      conn.commit()
     except sqlite3.Error as e:
       app.logger.error("Failed to execute callback in DBT: %s", e)
-      cls.__rollback()
+      conn.rollback()
     finally:
-      cls.__reset(app)
+      cls.__reset()
@@ -0,0 +1,65 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from keeper import get_optional_info
+
+class Dispatcher:
+  default_pool = "default"
+  provision_pool = "provision"
+  default_conf = {
+    "WORKERS": 8,
+    # Multi-minute VM provisioning gets its own workers so short tasks are never starved.
+    "POOLS": {"provision": 4},
+  }
+  executors = {}
+  lock = threading.Lock()
+  counters = {}
+
+  @classmethod
+  def get_conf(cls):
+    conf = dict(cls.default_conf)
+    conf.update(get_optional_info("DISPATCH_CONF", {}))
+    return conf
+
+  @classmethod
+  def get_executor(cls, pool=default_pool):
+    with cls.lock:
+      if pool not in cls.executors:
+        conf = cls.get_conf()
+        workers = conf["WORKERS"] if pool == cls.default_pool else conf["POOLS"].get(pool, conf["WORKERS"])
+        cls.executors[pool] = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="keeper-%s" % (pool,))
+      return cls.executors[pool]
+
+  @classmethod
+  def submit(cls, app, fn, *args, **kwargs):
+    return cls.submit_to(cls.default_pool, app, fn, *args, **kwargs)
+
+  @classmethod
+  def submit_to(cls, pool, app, fn, *args, **kwargs):
+    current = app._get_current_object() if hasattr(app, "_get_current_object") else app
+    def run():
+      with current.app_context():
+        try:
+          result = fn(*args, **kwargs)
+          cls._count(pool, "completed")
+          return result
+        except Exception as e:
+          cls._count(pool, "failed")
+          current.logger.error("Dispatched %s failed: %s", fn.__name__, e)
+          raise
+        finally:
+          cls._count(pool, "pending", -1)
+    cls._count(pool, "submitted")
+    cls._count(pool, "pending")
+    return cls.get_executor(pool).submit(run)
+
+  @classmethod
+  def _count(cls, pool, name, delta=1):
+    with cls.lock:
+      counters = cls.counters.setdefault(pool, {"submitted": 0, "completed": 0, "failed": 0, "pending": 0})
+      counters[name] += delta
+
+  @classmethod
+  def stats(cls):
+    with cls.lock:
+      return {pool: dict(counters) for pool, counters in cls.counters.items()}
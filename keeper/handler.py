@@ -12,6 +12,17 @@ from keeper.model import User, Project, VM, Snapshot, Runner
 from . import get_info
 
 from keeper.util import SSHUtil
+from keeper.cache import TTLCache
+from keeper.content import ContentCache
+from keeper.client import HTTPClient
+from keeper.ratelimit import RateLimiter
+from keeper.webhook import WebhookQueue
+from keeper.dispatch import Dispatcher
+from keeper.pipeline import PipelineDispatcher
+from keeper.warmpool import WarmPool
+from keeper.hosts import HostRegistry
+from keeper.status import GlobalStatusPoller
+from keeper.reconciler import Reconciler
 
 bp = Blueprint("handler", __name__, url_prefix="/api/v1")
 
@@ -59,7 +70,7 @@ def snapshot():
     current_app.logger.debug(SSHUtil.exec_script(current_app, filepath, vm_runner['vm_id'], snapshot_name, custom_conf=custom_conf))
   except KeeperException as e:
     current_app.logger.error(e)
-    return abort(e.message, "Failed to execute script file: %s" % '%s-restore-snapshot.sh' % target)
+    return abort(e.code, "Failed to execute script file: %s" % '%s-restore-snapshot.sh' % target)
   finally:
     if manager.get_runner_id() is not None:
       manager.toggle_runner('true')
@@ -177,4 +188,12 @@ def update_project_runner(runner_token=None):
     KeeperManager.update_runner_token(username, project_name, runner_token, current_app)
     return jsonify(message="Successful updated project: %s with runner token: %s" % (project_name, runner_token))
   except KeeperException as e:
-    return abort(e.code, e.message)
\ No newline at end of file
+    return abort(e.code, e.message)
+
+@bp.route('/stats')
+def stats():
+  return jsonify(caches=TTLCache.stats_all(), content=ContentCache.stats(), http=HTTPClient.stats(), rate_limit=RateLimiter.stats(),
+    webhook=WebhookQueue.stats(), dispatch=Dispatcher.stats(),
+    pipeline=PipelineDispatcher.stats(), warm_pool=WarmPool.stats(),
+    hosts=HostRegistry.stats(), ssh=SSHUtil.stats(),
+    global_status=GlobalStatusPoller.stats(), reconciler=Reconciler.stats())
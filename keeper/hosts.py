@@ -0,0 +1,124 @@
+import ipaddress
+import threading
+
+from keeper import db
+from keeper import get_optional_info
+
+class HostRegistry:
+  lock = threading.Lock()
+  synced = None
+  default_host = {
+    "MEMORY": 0,
+    "MAX_VMS": 0,
+    "IP_RANGES": [],
+  }
+
+  @classmethod
+  def get_hosts(cls):
+    hosts = {}
+    for host in get_optional_info("HOSTS", []):
+      conf = dict(cls.default_host)
+      conf.update(host)
+      hosts[conf["NAME"]] = conf
+    return hosts
+
+  @classmethod
+  def is_enabled(cls):
+    return len(get_optional_info("HOSTS", [])) > 0
+
+  @classmethod
+  def expand_range(cls, ip_range):
+    if "-" in ip_range:
+      start, end = [ipaddress.ip_address(ip.strip()) for ip in ip_range.split("-", 1)]
+      return [str(ipaddress.ip_address(i)) for i in range(int(start), int(end) + 1)]
+    network = ipaddress.ip_network(ip_range, strict=False)
+    if network.num_addresses == 1:
+      return [str(network.network_address)]
+    return [str(ip) for ip in network.hosts()]
+
+  @classmethod
+  def sync(cls, app):
+    hosts = cls.get_hosts()
+    with cls.lock:
+      if cls.synced == hosts:
+        return
+      owners = {}
+      for name, host in hosts.items():
+        for ip_range in host["IP_RANGES"]:
+          for address in cls.expand_range(ip_range):
+            if owners.setdefault(address, name) != name:
+              from keeper.manager import KeeperException
+              raise KeeperException(500, "IP: %s is in the IP_RANGES of both host: %s and host: %s." % (address, owners[address], name))
+      for name, host in hosts.items():
+        addresses = [address for address, owner in owners.items() if owner == name]
+        if addresses:
+          db.upsert_host_ip_provisions(name, addresses, app)
+          app.logger.debug("Synced %d IP provisions to host: %s", len(addresses), name)
+      cls.synced = hosts
+
+  @classmethod
+  def get_ranker(cls, vm_memory, app):
+    if not cls.is_enabled():
+      return None
+    cls.sync(app)
+    hosts = cls.get_hosts()
+    vm_memory = int(vm_memory)
+    def rank(loads):
+      return cls.rank(hosts, loads, vm_memory)
+    return rank
+
+  @classmethod
+  def rank(cls, hosts, loads, vm_memory):
+    candidates = []
+    for name, host in hosts.items():
+      vms = loads[name]["vms"] if name in loads else 0
+      memory = loads[name]["memory"] if name in loads else 0
+      if host["MAX_VMS"] > 0 and vms >= host["MAX_VMS"]:
+        continue
+      if host["MEMORY"] > 0 and memory + vm_memory > host["MEMORY"]:
+        continue
+      load = max(
+        memory / host["MEMORY"] if host["MEMORY"] > 0 else 0,
+        vms / host["MAX_VMS"] if host["MAX_VMS"] > 0 else 0)
+      candidates.append((load, vms, name))
+    return [name for _, _, name in sorted(candidates)]
+
+  @classmethod
+  def place(cls, vm_dir, ip_address, vm_memory, app):
+    if not cls.is_enabled():
+      return None
+    host_name = db.get_host_name_by_ip(ip_address)
+    if host_name:
+      db.insert_vm_host(vm_dir, host_name, int(vm_memory), app)
+      app.logger.debug("Placed VM: %s on host: %s", vm_dir, host_name)
+    return host_name
+
+  @classmethod
+  def get_host_of_vm(cls, vm_dir):
+    if not cls.is_enabled():
+      return None
+    host_name = db.get_vm_host_name(vm_dir)
+    if not host_name:
+      return None
+    return cls.get_hosts().get(host_name)
+
+  @classmethod
+  def get_ssh_conf(cls, host):
+    if not host:
+      return None
+    return {"HOST": host["HOST"], "USERNAME": host["USERNAME"], "PASSWORD": host["PASSWORD"]}
+
+  @classmethod
+  def stats(cls):
+    if not cls.is_enabled():
+      return {}
+    loads = db.get_host_loads()
+    stats = {}
+    for name, host in cls.get_hosts().items():
+      stats[name] = {
+        "vms": loads[name]["vms"] if name in loads else 0,
+        "memory": loads[name]["memory"] if name in loads else 0,
+        "max_vms": host["MAX_VMS"],
+        "max_memory": host["MEMORY"],
+      }
+    return stats
@@ -1,23 +1,25 @@
 from flask import (
-  Blueprint, current_app, jsonify, url_for, abort, request
+  Blueprint, current_app, jsonify, abort, request
 )
 
 import os
-from urllib.parse import urljoin
 
 from keeper import get_info
 
 from keeper.manager import *
 from keeper.model import *
-from keeper.vm import recycle_vm
+from keeper.vm import recycle_vm, provision_vm, provision_warm_vm
+from keeper.dispatch import Dispatcher
+from keeper.pipeline import PipelineQueue, PipelineDispatcher
+from keeper.warmpool import WarmPool
 
-import queue
-import time
-import threading
-import requests
 
 bp = Blueprint("integration", __name__ ,url_prefix="/api/v1")
 
+@bp.before_app_request
+def start_pipeline_dispatcher():
+  PipelineDispatcher.ensure_started(current_app._get_current_object())
+
 @bp.route("/issues/assign", methods=["POST"])
 def issue_assign():
   username = request.args.get('username', None)
@@ -39,8 +41,7 @@ def issue_assign():
     data["label"] = "issue"
 
   try:
-    project = KeeperManager.resolve_project(username, project_name, current_app)
-    KeeperManager.post_issue_to_assignee(project.project_id, data['title'], data['description'], data['label'], data['assignee'], current_app)
+    KeeperManager.assign_issue(IssueRequest(username, project_name, data['title'], data['description'], data['label'], data['assignee']), current_app)
     return jsonify(message="Successful assigned issue to user: %s under project: %s" % (username, project_name))
   except KeeperException as e:
     current_app.logger.error(e)
@@ -132,8 +133,6 @@ def issue_open_peer():
     current_app.logger.error(e)
     return abort(e.code, e.message)
 
-q = queue.PriorityQueue()
-
 @bp.route("/runners/probe")
 def runner_probe():
   project_id = request.args.get("project_id", None)
@@ -145,21 +144,12 @@ def runner_probe():
   status = request.args.get("status", None)
   if not status:
     return abort(400, "Status is required.")
-  while not q.empty():
-    pipeline_task = q.get()
-    pipeline_id = pipeline_task.id
-    current_app.logger.debug("Got pipeline ID: %d from queue with priority: %d", pipeline_id, pipeline_task.priority)
-    try: 
-      KeeperManager.get_ip_provision(project_id, current_app)
-      current_app.logger.debug("Pipeline: %d will be retried as the project pipeline jobs has been released.", pipeline_id)
-      KeeperManager.retry_pipeline(int(project_id), pipeline_id, current_app)
-    except KeeperException:
-      q.put(pipeline_task)
-      current_app.logger.debug("Pipeline: %d was hanged up as the project pipeline jobs has been reserved by others.", pipeline_id)
-    time.sleep(3)
-  message = "None of queued pipelines."
-  current_app.logger.debug(message)
-  return message
+  PipelineDispatcher.notify("probe from project: %s" % (project_id,), current_app)
+  return "Pipeline dispatcher has been signaled."
+
+@bp.route("/pipelines/queue")
+def pipeline_queue():
+  return jsonify(pipelines=PipelineQueue.list())
 
 @bp.route("/runners", methods=["POST"])
 def prepare_runner():
@@ -186,11 +176,6 @@ def prepare_runner():
   vm_base_name = "%s-runner-%s" % (abbr_name, base_repo_name)
   vm_name = "%s-%d" % (vm_base_name, pipeline_id)
   current = current_app._get_current_object()
-  probe_request_url = urljoin("http://localhost:5000", url_for(".runner_probe", project_id=project_id, vm_name=vm_name, status=status))
-  def callback():
-    resp = requests.get(probe_request_url)
-    current.logger.debug("Requested URL: %s with status code: %d" % (probe_request_url, resp.status_code))
-  threading.Thread(target=callback).start()
   power_status = KeeperManager.get_runner_power_status(project_id, current_app)
   if status == "canceled":
     current_app.logger.debug("Runner reserved by project: %d, pipline: %d, is being canceled by user ...", project_id, pipeline_id)
@@ -201,6 +186,7 @@ def prepare_runner():
       return jsonify(message="Runner with pipeline: %d was canceled by user has already released.")
   if status in ["success", "failed"]:
     current_app.logger.debug("Runner mission is %s will be removing it...", status)
+    PipelineQueue.remove(pipeline_id, current_app)
     recycle_vm(current_app, vm_name, project_id, pipeline_id, status)
   if KeeperManager.get_ip_provision_by_pipeline(pipeline_id, current_app):
     current_app.logger.debug("VM would not be re-created as the pipeline is same with last one.")
@@ -209,10 +195,14 @@ def prepare_runner():
     current_app.logger.debug("Runner would not be prepared as the pipeline is %s.", status) 
     return jsonify(message="Runner would not be prepared as the pipeline is %s" % (status,))
   try:
-    ip_provision = KeeperManager.get_ip_provision(project_id, current_app)
-    KeeperManager.reserve_ip_provision(ip_provision.id, current_app)
+    vm_box = get_info("VM_CONF")["VM_BOX"]
+    vm_memory = get_info("VM_CONF")["VM_MEMORY"]
+    warm_vm = WarmPool.acquire(project_id, pipeline_id, vm_name, vm_box, vm_memory, current_app)
+    if warm_vm:
+      ip_provision = IPProvision(warm_vm["ip_provision_id"], warm_vm["ip_address"])
+    else:
+      ip_provision = KeeperManager.allocate_ip_provision(project_id, pipeline_id, current_app)
     KeeperManager.add_to_store(sha, {"runner_ip": ip_provision.ip_address}, current_app)
-    KeeperManager.register_ip_runner(ip_provision.id, pipeline_id, project_id, current_app)
   except KeeperException as e:
     current_app.logger.error(e.message)    
     if e.code == 412 and power_status in [KeeperManager.powered_on, KeeperManager.powered_on_using]:
@@ -223,7 +213,7 @@ def prepare_runner():
     if not KeeperManager.get_ip_provision_by_pipeline(pipeline_id, current_app):
       project = KeeperManager.resolve_project_with_priority(username, project_name, current_app)
       KeeperManager.cancel_runner_status(project_id, pipeline_id, KeeperManager.canceled_for_queue, current_app)
-      q.put(PipelineTask(pipeline_id, project.priority))
+      PipelineQueue.enqueue(pipeline_id, project_id, project.priority, current_app)
       current_app.logger.debug("Pipeline: %d has queued for executing with priority: %d and canceled for queue.", pipeline_id, project.priority)
     return abort(e.code, e.message)
   current_app.logger.debug("Runner with pipeline: %d status is %s, with IP provision ID: %d, IP: %s", pipeline_id, status, ip_provision.id, ip_provision.ip_address)
@@ -235,10 +225,10 @@ def prepare_runner():
       "runner_name": vm_name,
       "runner_tag": "%s-vm" % (vm_base_name)
     }
-    request_url = urljoin("http://localhost:5000", url_for("vm.vm", name=vm_name, username=username, project_id=project_id, project_name=project_name, status=status))
-    resp = requests.post(request_url, json=vm_conf, params={"ip_provision_id": ip_provision.id, "pipeline_id": pipeline_id})
+    vm_request = VMRequest(vm_name, username, project_id, project_name, status, ip_provision.id, pipeline_id, vm_conf)
     KeeperManager.update_runner_power_status(username, project_name, ip_provision.id, KeeperManager.powering_on, current_app)
-    message = "Requested URL: %s with status code: %d, update target VM power status as powered on." % (request_url, resp.status_code)
+    Dispatcher.submit_to(Dispatcher.provision_pool, current, provision_warm_vm if warm_vm else provision_vm, current, vm_request)
+    message = "Dispatched VM creation: %s, update target VM power status as powering on." % (vm_request,)
     current_app.logger.debug(message)
     return message
   except Exception as e:
@@ -380,14 +370,8 @@ def tag_release():
   KeeperManager.add_to_store(checkout_sha, {"repo_version": "%s-%s" %(project_name, version)}, current_app)
   def request_with_action(action):
     current_app.logger.debug("Version info: %s", version_info)
-    release_url = urljoin("http://localhost:5000", url_for("assistant.release", action=action, operator=username, 
-    release_repo=release_repo, release_branch=release_branch, category=checkout_sha, 
-    version_info=version_info, project_name=project_name, version=version))
-    resp = requests.post(release_url)
-    message = "Requested release URL: %s to %s files, with status code: %s" % (release_url, action, resp.status_code)
-    if resp.status_code == 400:
-      raise KeeperException(400, "Failed to request release URL: %s." % (release_url,))
-    current_app.logger.debug(message)
+    release_request = ReleaseRequest(action, username, release_repo, release_branch, checkout_sha, version_info, project_name, version)
+    current_app.logger.debug(KeeperManager.release_to_repository(release_request, current_app))
   message = ""
   try:
     request_with_action("create")
@@ -397,7 +381,7 @@ def tag_release():
       request_with_action("update")
       message = "Retried to release by updating file to the repository: %s for the branch: %s" % (release_repo, release_branch)
     else:
-      message = "Failed to request release URL with error: %s" % (ke.message,)
+      message = "Failed to release with error: %s" % (ke.message,)
   current_app.logger.debug(message)
   return message
 
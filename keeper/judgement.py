@@ -0,0 +1,74 @@
+import re
+import threading
+
+from keeper import db
+
+class JudgementScanner:
+  def __init__(self, pattern, overlap=4096):
+    self.pattern = pattern
+    self.overlap = overlap
+    self.max_pending = max(overlap * 4, 65536)
+    self.carry = ""
+    self.matched = False
+
+  def feed(self, text):
+    if self.matched or not text:
+      return self.matched
+    window = self.carry + text
+    # Only complete lines are scanned so that ^ and $ keep their multiline meaning.
+    cut = window.rfind("\n") + 1
+    if cut == 0:
+      if len(window) < self.max_pending:
+        self.carry = window
+        return False
+      cut = len(window)
+    if self.pattern.search(window, 0, cut):
+      self.matched = True
+      self.carry = ""
+      return True
+    tail = window[max(0, cut - self.overlap):cut]
+    if cut > self.overlap and "\n" in tail:
+      tail = tail[tail.index("\n") + 1:]
+    self.carry = tail + window[cut:]
+    return False
+
+  def scan(self, text, chunk_size=65536):
+    for i in range(0, len(text), chunk_size):
+      if self.feed(text[i:i + chunk_size]):
+        break
+    return self.finish()
+
+  def finish(self):
+    if not self.matched and self.carry:
+      self.matched = self.pattern.search(self.carry) is not None
+    self.carry = ""
+    return self.matched
+
+class JudgementEngine:
+  lock = threading.Lock()
+  rules = None
+
+  @classmethod
+  def _ensure_loaded(cls, app):
+    with cls.lock:
+      if cls.rules is not None:
+        return cls.rules
+      rules = {}
+      for r in db.get_job_log_judgements(app):
+        try:
+          rules[r["rule_name"]] = re.compile(r["rule"], re.M)
+        except re.error as e:
+          app.logger.error("Failed to compile job log judgement: %s with error: %s", r["rule_name"], e)
+          rules[r["rule_name"]] = e
+      app.logger.debug("Loaded %d job log judgement rules.", len(rules))
+      cls.rules = rules
+      return rules
+
+  @classmethod
+  def get_rule(cls, rule_name, app):
+    return cls._ensure_loaded(app).get(rule_name)
+
+  @classmethod
+  def invalidate(cls):
+    with cls.lock:
+      cls.rules = None
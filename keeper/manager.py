@@ -3,15 +3,24 @@ from requests.auth import HTTPBasicAuth
 
 from keeper.model import *
 from keeper import db
-from keeper import get_info
-from keeper.util import TemplateUtil, SSHUtil
+from keeper import get_info, get_optional_info
+from keeper.util import TemplateUtil, SSHUtil, ConcurrentUtil, TraceBuffer
+from keeper.client import HTTPClient
+from keeper.ratelimit import RateLimiter
+from keeper.cache import TTLCache
+from keeper.principal import TokenIndex
+from keeper.judgement import JudgementEngine, JudgementScanner
+from keeper.content import ContentCache
+from keeper.hosts import HostRegistry
+from keeper.status import GlobalStatusPoller
 
 import re
+import shlex
 from urllib import parse
 import os
 from json.decoder import JSONDecodeError
 from datetime import datetime, timedelta
-import random
+import codecs
 
 class KeeperException(Exception):
   def __init__(self, code, message):
@@ -48,18 +57,21 @@ class KeeperManager:
   def get_keeper_url(self):
     return self.get_vm_with_runner()['keeper_url']
 
+  def get_vm_dir(self):
+    return db.get_warm_vm_dir(self.vm_name) or self.vm_name
+
   def get_vm_snapshot_name(self, vm_name):
     return db.get_vm_snapshot(vm_name)['snapshot_name']
 
   def toggle_runner(self, status):
     request_url = "%s/runners/%d?private_token=%s" % (KeeperManager.get_gitlab_api_url(), self.get_runner_id(), self.get_token())
-    resp = requests.put(request_url, data={'active': status})
+    resp = KeeperManager.send_request('PUT', request_url, self.current, data={'active': status})
     self.current.logger.debug("Requested URL: %s to toggle runner status as %s", request_url, status)
     if resp.status_code >= 400:
       raise KeeperException(resp.status_code, 'Failed to request with URL: %s' % request_url)
 
   def dispatch_task(self, dispatch_url):
-    resp = requests.get(dispatch_url)
+    resp = KeeperManager.send_request('GET', dispatch_url, self.current)
     self.current.logger.debug("Requested URL: %s with status: %d", dispatch_url, resp.status_code)
     if resp.status_code >= 400:
       raise KeeperException(resp.status_code, 'Failed to request with URL: %s' % dispatch_url)
@@ -70,30 +82,70 @@ class KeeperManager:
     vm_conf["gitlab_url"] = get_info("GITLAB_URL")
     vm_conf["runner_name"] = self.vm_name
     vm_conf["runner_token"] = runner_token
-    vagrant_file_path = os.path.join(get_info("LOCAL_OUTPUT"), self.vm_name)
+    vagrant_file_path = os.path.join(get_info("LOCAL_OUTPUT"), self.get_vm_dir())
     TemplateUtil.render_file(vagrant_file_path, "Vagrantfile", vm_conf)
 
+  def get_host_info(self, key):
+    host = HostRegistry.get_host_of_vm(self.get_vm_dir())
+    if host and key in host:
+      return host[key]
+    return get_info(key)
+
+  def get_host_name(self):
+    host = HostRegistry.get_host_of_vm(self.get_vm_dir())
+    return host["NAME"] if host else None
+
+  def get_host_ssh_conf(self):
+    return HostRegistry.get_ssh_conf(HostRegistry.get_host_of_vm(self.get_vm_dir()))
+
+  def place_vm(self, vm_conf):
+    return HostRegistry.place(self.get_vm_dir(), vm_conf["vm_ip"], vm_conf["vm_memory"], self.current)
+
   def copy_vm_files(self):
-    local_vagrantfile_path = os.path.join(get_info("LOCAL_OUTPUT"), self.vm_name, "Vagrantfile")
-    remote_dest_path = os.path.join(get_info("VM_DEST_PATH"), self.vm_name)
+    vm_dir = self.get_vm_dir()
+    local_vagrantfile_path = os.path.join(get_info("LOCAL_OUTPUT"), vm_dir, "Vagrantfile")
+    remote_dest_path = os.path.join(self.get_host_info("VM_DEST_PATH"), vm_dir)
+    ssh_conf = self.get_host_ssh_conf()
     # SSHUtil.secure_copy(self.current, get_info("VM_SRC_PATH"), remote_dest_path)
-    SSHUtil.exec_script(self.current, "cp -R %s %s" % (get_info("VM_SRC_PATH"), remote_dest_path))
-    SSHUtil.secure_copyfile(self.current, local_vagrantfile_path, remote_dest_path)
+    SSHUtil.exec_script(self.current, "cp -R %s %s" % (self.get_host_info("VM_SRC_PATH"), remote_dest_path), custom_conf=ssh_conf)
+    SSHUtil.secure_copyfile(self.current, local_vagrantfile_path, remote_dest_path, custom_conf=ssh_conf)
     
   
   def __base_vagrant_operation(self, *operation):
-    vm_path = os.path.join(get_info("VM_DEST_PATH"), self.vm_name)
-    return SSHUtil.exec_script(self.current, "cd %s && PATH=/usr/local/bin:$PATH vagrant" % vm_path, *operation)
+    vm_path = os.path.join(self.get_host_info("VM_DEST_PATH"), self.get_vm_dir())
+    return SSHUtil.exec_script(self.current, "cd %s && PATH=/usr/local/bin:$PATH vagrant" % vm_path, *operation, custom_conf=self.get_host_ssh_conf())
 
   def create_vm(self):
-    return self.__base_vagrant_operation("up")
+    try:
+      return self.__base_vagrant_operation("up")
+    finally:
+      GlobalStatusPoller.invalidate(self.get_host_name())
+
+  def register_runner_in_vm(self, runner_token, runner_tag):
+    command = "sudo gitlab-runner register --name %s --url=%s --registration-token=%s --executor=shell --non-interactive --tag-list %s" % (
+      shlex.quote(self.vm_name), shlex.quote(get_info("GITLAB_URL")), shlex.quote(runner_token), shlex.quote(runner_tag))
+    # The command is parsed once by the host shell and again by the shell inside the VM.
+    return self.__base_vagrant_operation("ssh", "-c", shlex.quote(command))
+
+  def save_snapshot(self, snapshot_name):
+    return self.__base_vagrant_operation("snapshot", "save", snapshot_name)
+
+  def restore_snapshot(self, snapshot_name):
+    return self.__base_vagrant_operation("snapshot", "restore", "--no-provision", snapshot_name)
+
+  def check_runner_health(self):
+    try:
+      output = self.__base_vagrant_operation("ssh", "-c", shlex.quote("sudo gitlab-runner status"))
+    except KeeperException as e:
+      self.current.logger.error(e.message)
+      return False
+    return "is running" in output
 
   def get_global_status(self):
     return self.__base_vagrant_operation("global-status")
 
   def get_vm_info(self):
-    raw_output = self.get_global_status()
-    vm_global_status = VMGlobalStatus.parse(raw_output, self.vm_name)
+    vm_global_status = GlobalStatusPoller.lookup(self.get_vm_dir(), self.get_host_name(), self.current)
     if vm_global_status is None:
       raise KeeperException(404, "VM: %s does not exist." % self.vm_name)
     return vm_global_status
@@ -107,9 +159,32 @@ class KeeperManager:
       self.current.logger.debug("VM: %s does not exist.", self.vm_name)
       return False
 
+  def remove_vm_files(self):
+    vm_dir = self.get_vm_dir()
+    if HostRegistry.is_enabled() and HostRegistry.get_host_of_vm(vm_dir) is None:
+      # Without a recorded host the same path on the default host may belong to another VM.
+      self.current.logger.debug("No host recorded for VM: %s, its directory is not removed.", vm_dir)
+      return None
+    vm_path = os.path.join(self.get_host_info("VM_DEST_PATH"), vm_dir)
+    return SSHUtil.exec_script(self.current, "rm", "-rf", vm_path, custom_conf=self.get_host_ssh_conf())
+
   def force_delete_vm(self):
-    vm_info = self.get_vm_info()
-    return self.__base_vagrant_operation("destroy", "-f", vm_info.id)
+    host_name = self.get_host_name()
+    try:
+      try:
+        vm_info = self.get_vm_info()
+      except KeeperException as e:
+        if e.code == 404:
+          # A VM that never came up still leaves the copied VM directory behind.
+          self.remove_vm_files()
+        raise
+      output = self.__base_vagrant_operation("destroy", "-f", vm_info.id)
+      # vagrant destroy keeps the VM directory, remove it while its host is still recorded.
+      self.remove_vm_files()
+      return output
+    finally:
+      db.remove_vm_host(self.get_vm_dir(), self.current)
+      GlobalStatusPoller.invalidate(host_name)
 
   def get_custom_conf(self):
     conf = None
@@ -131,33 +206,41 @@ class KeeperManager:
       app.logger.error("VM: %s with snapshot: %s already exists." % (vm.vm_name, snapshot.snapshot_name))
       raise KeeperException(409, "VM: %s with snapshot: %s already exists." % (vm.vm_name, snapshot.snapshot_name))
 
+  @staticmethod
+  def send_request(method, request_url, app, **kwargs):
+    try:
+      return HTTPClient.request(method, request_url, **kwargs)
+    except requests.RequestException as e:
+      app.logger.error("Failed to request URL: %s with error: %s", request_url, e)
+      raise KeeperException(503, "Failed to request URL: %s with error: %s" % (request_url, e))
+
   @staticmethod
   def get_gitlab_users(username, token, app):
     request_url = "%s/users?username=%s&private_token=%s" % (KeeperManager.get_gitlab_api_url(), username, token)
-    resp = requests.get(request_url)
+    resp = KeeperManager.send_request('GET', request_url, app)
     if resp.status_code >= 400:
       app.logger.error("Failed to request URL: %s with status code: %d", request_url, resp.status_code)
       raise KeeperException(resp.status_code, "Failed to request URL: %s with status code: %d" % (request_url, resp.status_code))
     return resp.json()
 
   @staticmethod
-  def get_gitlab_projects(token, app):
-    request_url = "%s/projects?private_token=%s&per_page=200" % (KeeperManager.get_gitlab_api_url(), token)
-    resp = requests.get(request_url)
-    if resp.status_code >= 400:
-      app.logger.error("Failed to request URL: %s with status code: %d", request_url, resp.status_code)
-      raise KeeperException(resp.status_code, "Failed to request URL: %s with status code: %d" % (request_url, resp.status_code))
-    return resp.json()
+  def get_gitlab_project(project_name, token, app):
+    request_url = "%s/projects/%s" % (KeeperManager.get_gitlab_api_url(), parse.quote(project_name, safe=""))
+    return KeeperManager.send_gitlab_request(token, request_url, app, method='GET').json()
 
   @staticmethod
   def get_gitlab_runners(project_id, app):
+    return list(KeeperManager.iterate_gitlab_runners(project_id, app))
+
+  @staticmethod
+  def iterate_gitlab_runners(project_id, app):
     app.logger.debug("Get gitlab runner with project ID: %d", project_id)
     request_url = "%s/projects/%d/runners" % (KeeperManager.get_gitlab_api_url(), project_id)
-    return KeeperManager.request_gitlab_api(project_id, request_url, app, method='GET')
+    return KeeperManager.paginate_gitlab_api(project_id, request_url, app)
 
   @staticmethod
   def resolve_runner(project_id, runner_name, app):
-    runners = KeeperManager.get_gitlab_runners(project_id, app)
+    runners = KeeperManager.iterate_gitlab_runners(project_id, app)
     runner = Runner(runner_name)
     for r in runners:
       if r['description'] == runner_name:
@@ -189,29 +272,22 @@ class KeeperManager:
     return KeeperManager.request_gitlab_api(project_id, request_url, app, method='GET')
 
   @staticmethod
-  def request_gitlab_api(principle, request_url, app, method='POST', by_principle='project_id', params={}, resp_raw=False):
-    r = None
+  def resolve_principle_token(principle, by_principle, app):
+    token = None
     if by_principle == 'username':
-      r = db.get_user_info(principle)
+      token = TokenIndex.get_user_token(principle)
     elif by_principle == 'project_id':
-      r = db.get_user_token_by_project(principle)
-    if r is None:
+      token = TokenIndex.get_project_token(principle)
+    if token is None:
       app.logger.error("Failed to get token with principle: %r", principle)
       raise KeeperException(404, "Failed to get token with principle: %r" % (principle,))
-    app.logger.debug("Got token: %s, params: %s", r['token'], params)
-    resp = None
-    default_headers={"PRIVATE-TOKEN": r['token']}
-    if method == 'POST':
-      resp = requests.post(request_url, headers=default_headers, json=params)
-    elif method == 'GET':
-      resp = requests.get(request_url, headers=default_headers, params=params)
-    elif method == 'PUT':
-      resp = requests.put(request_url, headers=default_headers, json=params)
-    elif method == 'DELETE':
-      resp = requests.delete(request_url, headers=default_headers)
-    if resp.status_code >= 400:
-      app.logger.error("Failed to request URL: %s with status code: %d with content: %s", request_url, resp.status_code, resp.content)
-      raise KeeperException(resp.status_code, "Failed to request URL: %s with status code: %d with content: %s" % (request_url, resp.status_code, resp.content))
+    return token
+
+  @staticmethod
+  def request_gitlab_api(principle, request_url, app, method='POST', by_principle='project_id', params={}, resp_raw=False):
+    token = KeeperManager.resolve_principle_token(principle, by_principle, app)
+    app.logger.debug("Got token: %s, params: %s", token, params)
+    resp = KeeperManager.send_gitlab_request(token, request_url, app, method=method, params=params)
     try:
       if resp_raw:
         return resp.text
@@ -219,10 +295,58 @@ class KeeperManager:
     except JSONDecodeError:
       pass
 
+  @staticmethod
+  def paginate_gitlab_api(principle, request_url, app, by_principle='project_id', params={}):
+    token = KeeperManager.resolve_principle_token(principle, by_principle, app)
+    return KeeperManager.iterate_gitlab_pages(token, request_url, app, params=params)
+
+  @staticmethod
+  def iterate_gitlab_pages(token, request_url, app, params={}):
+    params = dict(params)
+    params.setdefault("per_page", 100)
+    while request_url:
+      resp = KeeperManager.send_gitlab_request(token, request_url, app, method='GET', params=params)
+      for item in resp.json():
+        yield item
+      # The next link (offset or keyset) already carries every query parameter.
+      request_url = resp.links.get("next", {}).get("url")
+      params = {}
+
+  @staticmethod
+  def get_request_priority(request_url):
+    path = parse.urlsplit(request_url).path
+    if re.search(r"/runners|/pipelines/\d+/(retry|cancel)|/trigger/pipeline", path):
+      return RateLimiter.high_priority
+    if re.search(r"/issues|/notes|/discussions|/comments|/merge_requests", path):
+      return RateLimiter.low_priority
+    return RateLimiter.normal_priority
+
+  @staticmethod
+  def send_gitlab_request(token, request_url, app, method='POST', params={}, stream=False):
+    resp = None
+    default_headers={"PRIVATE-TOKEN": token}
+    priority = KeeperManager.get_request_priority(request_url)
+    if method == 'POST':
+      resp = KeeperManager.send_request('POST', request_url, app, headers=default_headers, json=params, priority=priority)
+    elif method == 'GET':
+      resp = KeeperManager.send_request('GET', request_url, app, headers=default_headers, params=params, stream=stream, revalidate=True, priority=priority)
+    elif method == 'PUT':
+      resp = KeeperManager.send_request('PUT', request_url, app, headers=default_headers, json=params, priority=priority)
+    elif method == 'DELETE':
+      resp = KeeperManager.send_request('DELETE', request_url, app, headers=default_headers, priority=priority)
+    if resp.status_code >= 400:
+      try:
+        app.logger.error("Failed to request URL: %s with status code: %d with content: %s", request_url, resp.status_code, resp.content)
+        raise KeeperException(resp.status_code, "Failed to request URL: %s with status code: %d with content: %s" % (request_url, resp.status_code, resp.content))
+      finally:
+        # Nobody gets to close a streamed response that fails, hand its connection back to the pool here.
+        resp.close()
+    return resp
+
   @staticmethod
   def request_sonarqube_api(sonarqube_token, request_url, app):
     app.logger.debug("Got Sonarqube token: %s", sonarqube_token)
-    resp = requests.get(request_url, auth=HTTPBasicAuth(sonarqube_token,""))
+    resp = KeeperManager.send_request('GET', request_url, app, auth=HTTPBasicAuth(sonarqube_token,""))
     if resp.status_code >= 400:
       app.logger.error("Failed to request URL: %s with status code: %d with content: %s", request_url, resp.status_code, resp.content)
       raise KeeperException(resp.status_code, "Failed to request URL: %s with status code: %d with content: %s" % (request_url, resp.status_code, resp.content))
@@ -247,6 +371,12 @@ class KeeperManager:
     request_url = "%s/projects/%d/pipelines/%d/retry" % (KeeperManager.get_gitlab_api_url(), project_id, pipeline_id)
     return KeeperManager.request_gitlab_api(project_id, request_url, app)
 
+  @staticmethod
+  def get_pipeline(project_id, pipeline_id, app):
+    app.logger.debug("Get pipeline with project ID: %d, pipeline ID: %d", project_id, pipeline_id)
+    request_url = "%s/projects/%d/pipelines/%d" % (KeeperManager.get_gitlab_api_url(), project_id, pipeline_id)
+    return KeeperManager.request_gitlab_api(project_id, request_url, app, method='GET')
+
   @staticmethod
   def cancel_pipeline(project_id, pipeline_id, app):
     app.logger.debug("Cancel pipeline with project ID: %d, pipeline ID: %d", project_id, pipeline_id)
@@ -266,6 +396,30 @@ class KeeperManager:
     params = {"branch": branch_name, "start_branch": branch_name, "commit_message": commit_message, "actions": actions}
     return KeeperManager.request_gitlab_api(project_id, request_url, app, params=params)
 
+  @staticmethod
+  def release_to_repository(release_request, app):
+    project = KeeperManager.resolve_project(release_request.operator, release_request.release_repo, app)
+    project_id = project.project_id
+    try:
+      KeeperManager.create_branch(project_id, release_request.version_info, release_request.release_branch, app)
+    except KeeperException as ke:
+      app.logger.error(ke)
+    try:
+      action = release_request.action
+      actions = []
+      md_content = KeeperManager.resolve_action_from_store(release_request.category, ".md", app, release_request.project_name, release_request.version)
+      actions.append({"action": action, "file_path": "install.md", "content": md_content})
+      actions.append({"action": action, "file_path": "install.sh", "content": KeeperManager.resolve_action_from_store(release_request.category, ".sh", app, release_request.project_name, release_request.version)})
+      email = "%s@inspur.com" %(release_request.operator,)
+      history_file_path = "history/release-{}.md".format(release_request.version,)
+      KeeperManager.manipulate_file_to_repository(action, project_id, release_request.version_info, release_request.operator, email, history_file_path, md_content, app)
+      KeeperManager.commit_files(project_id, release_request.version_info, "Commit files about release: %s" %(release_request.version_info,), actions, app)
+      return "Successful released version: %s to project: %s with action: %s" %(release_request.version, release_request.project_name, action)
+    except KeeperException as ke:
+      message = "Failed to commit files to the repository: %s, with error: %s" % (release_request.release_repo, ke)
+      app.logger.error(message)
+      raise KeeperException(400, message)
+
   @staticmethod
   def resolve_action_from_store(category, file_type, app, project_name=None, version_info=None):
     store = KeeperManager.get_from_store(category, app)
@@ -370,6 +524,12 @@ class KeeperManager:
     request_url = "%s/projects/%d/issues?title=%s&description=%s&labels=%s&assignee_ids=%s" % (KeeperManager.get_gitlab_api_url(), project_id, title, description, label, assignee_id)
     return KeeperManager.request_gitlab_api(project_id, request_url, app)
 
+  @staticmethod
+  def assign_issue(issue_request, app):
+    project = KeeperManager.resolve_project(issue_request.username, issue_request.project_name, app)
+    return KeeperManager.post_issue_to_assignee(project.project_id, issue_request.title, issue_request.description,
+      issue_request.label, issue_request.assignee, app)
+
   @staticmethod
   def update_issue(project_id, issue_iid, updates, app):
     app.logger.debug("Update issue to project ID: %d to issue IID: %d with changes: %s", project_id, issue_iid, updates)
@@ -407,27 +567,57 @@ class KeeperManager:
 
   @staticmethod
   def resolve_user(username, app):
-    r = db.get_user_info(username)
+    r = TokenIndex.get_user(username)
     if r is None:
       app.logger.error("User: %s does not exists." % username)
       raise KeeperException(404, "User: %s does not exists." % username)
-    return User(r['user_id'], username, r['token'])
+    return User(r[0], username, r[1])
 
   @staticmethod
   def resolve_branch_name(title, app):
     app.logger.debug("Resolve branch name with title: %s", title)
     return re.sub(r'\W', '-', title.lower()).strip('-')
 
+  @staticmethod
+  def get_project_cache():
+    return TTLCache.named("project", maxsize=1024, ttl=300, negative_ttl=30)
+
+  @staticmethod
+  def invalidate_project_cache(username=None, project_name=None):
+    KeeperManager.get_project_cache().invalidate_if(lambda key:
+      (username is None or key[0] == username) and (project_name is None or key[1] == project_name))
+
   @staticmethod
   def resolve_project(username, project_name, app):
+    cache = KeeperManager.get_project_cache()
+    cached = cache.get((username, project_name), TTLCache.missing)
+    if cached is TTLCache.missing:
+      try:
+        cached = KeeperManager.lookup_project(username, project_name, app).project_id
+        cache.set((username, project_name), cached)
+      except KeeperException as e:
+        if e.code != 404:
+          raise
+        cached = e
+        cache.set((username, project_name), cached, ttl=cache.negative_ttl)
+    if isinstance(cached, KeeperException):
+      raise KeeperException(cached.code, cached.message)
+    project = Project(project_name)
+    project.project_id = cached
+    return project
+
+  @staticmethod
+  def lookup_project(username, project_name, app):
     project = Project(project_name)
     token = KeeperManager.resolve_token(username, app)
-    projects = KeeperManager.get_gitlab_projects(token, app)
-    for p in projects:
-      if p['path_with_namespace'] == project_name:
-        project.project_id = p['id']
-        app.logger.debug("Obtained project: %s in project runner registration." % project) 
-        return project
+    try:
+      p = KeeperManager.get_gitlab_project(project_name, token, app)
+      project.project_id = p['id']
+      app.logger.debug("Obtained project: %s in project runner registration." % project)
+      return project
+    except KeeperException as e:
+      if e.code != 404:
+        raise
     app.logger.debug("Retrieve project ID from DB store.")
     u = db.get_user_info(username)
     if not u:
@@ -459,7 +649,7 @@ class KeeperManager:
          % (project.project_name, runner.runner_id, vm.vm_name, snapshot.snapshot_name))
 
   @staticmethod
-  def unregister_runner_by_name(runner_name, app):
+  def unregister_runner_by_name(runner_name, app, strict=False):
     rs = db.get_project_runner_by_name(runner_name)
     if len(rs) == 0:
       app.logger.error("Runner name: %s does not exist." % runner_name)
@@ -468,11 +658,19 @@ class KeeperManager:
         KeeperManager.remove_runner(r['project_id'], r['runner_id'], app)
       except KeeperException as e:
         app.logger.error("Error occurred while removing runner via API: %s", e)
+        if strict and e.code != 404:
+          raise
       db.delete_project_runner(r['project_id'], r['runner_id'], app)
       db.delete_runner(r['runner_id'], app)
       db.delete_vm(r['vm_id'], app)
       db.delete_snapshot(r['snapshot_name'], app)
-      SSHUtil.exec_script(app, "rm", '-rf', os.path.join(get_info("VM_DEST_PATH"), runner_name))
+      if db.get_warm_vm_dir(runner_name):
+        # Pooled VMs keep their directory, they are restored and handed out again.
+        continue
+      try:
+        KeeperManager(app, runner_name).remove_vm_files()
+      except KeeperException as e:
+        app.logger.error(e.message)
       
   @staticmethod
   def unregister_inrelevant_runner(project_id, runner_name, app):
@@ -497,6 +695,8 @@ class KeeperManager:
       raise KeeperException(404, "No user id found with provided username: %s" % username)
     user = users[0]
     db.insert_user(User(user['id'], username, token), app)
+    TokenIndex.refresh()
+    KeeperManager.invalidate_project_cache(username=username)
 
   @staticmethod
   def resolve_user_project(username, project_name, app):
@@ -520,6 +720,8 @@ class KeeperManager:
     app.logger.debug("Obtained user: %s" % user)
     db.insert_project(project, app)
     db.insert_user_project(user, project, app)
+    TokenIndex.refresh()
+    KeeperManager.invalidate_project_cache(project_name=project_name)
     
   @staticmethod
   def resolve_runner_token(username, project_name, app):
@@ -584,19 +786,42 @@ class KeeperManager:
 
   @staticmethod
   def get_ip_provision(project_id, app):
+    KeeperManager.check_ip_runner_reservation(project_id, app)
+    ip = db.get_available_ip()
+    if not ip:
+      raise KeeperException(404, "IP provision pool exhausted.")
+    return IPProvision(ip["id"], ip["ip_address"])
+
+  @staticmethod
+  def check_ip_runner_reservation(project_id, app):
     r = db.get_reserved_runner_by_project(project_id)
     if not r:
       KeeperManager.release_dead_lock_ip_runner(project_id, app)
-      ips = db.get_available_ip()
-      if len(ips) == 0:
-        raise KeeperException(404, "No IP provision found currently.")
-      ip = ips[random.randint(1, len(ips)) - 1]
-      app.logger.debug("Allocated IP: %s, with ID: %s", ip["ip_address"], ip["id"])
-      return IPProvision(ip["id"], ip["ip_address"])
-    elif r["is_canceled"] == KeeperManager.canceled_by_user:
+      return
+    if r["is_canceled"] == KeeperManager.canceled_by_user:
       raise KeeperException(412, "Runner to the project ID: %s has been signaled to cancel, please wait for it to recycle." % (project_id,))
     raise KeeperException(409, "IP runner already reserved.")
 
+  @staticmethod
+  def get_free_capacity(app):
+    vm_conf = get_info("VM_CONF")
+    return db.count_available_ips() + db.count_ready_warm_vms(vm_conf["VM_BOX"], int(vm_conf["VM_MEMORY"]))
+
+  @staticmethod
+  def allocate_ip_provision(project_id, pipeline_id, app, vm_memory=None):
+    KeeperManager.release_dead_lock_ip_runner(project_id, app)
+    if vm_memory is None:
+      vm_memory = get_info("VM_CONF")["VM_MEMORY"]
+    r, ip = db.allocate_ip_provision(project_id, pipeline_id, int(vm_memory), app, rank=HostRegistry.get_ranker(vm_memory, app))
+    if r:
+      if r["is_canceled"] == KeeperManager.canceled_by_user:
+        raise KeeperException(412, "Runner to the project ID: %s has been signaled to cancel, please wait for it to recycle." % (project_id,))
+      raise KeeperException(409, "IP runner already reserved.")
+    if not ip:
+      raise KeeperException(404, "IP provision pool exhausted.")
+    app.logger.debug("Allocated IP: %s, with ID: %s on host: %s to pipeline: %s", ip["ip_address"], ip["id"], ip["host_name"], pipeline_id)
+    return IPProvision(ip["id"], ip["ip_address"], ip["host_name"])
+
   @staticmethod
   def reserve_ip_provision(ip_provision_id, app):
     db.update_ip_provision_by_id(ip_provision_id, 1, app)
@@ -631,6 +856,22 @@ class KeeperManager:
         db.remove_ip_runner(ip_provision_id, app)
         db.update_ip_provision_by_id(ip_provision_id, 0, app)
       db.DBT.execute(app, t_callback)
+      KeeperManager.notify_capacity_released("dead lock of pipeline: %d" % (r["pipeline_id"],), app)
+
+  capacity_listeners = []
+
+  @staticmethod
+  def add_capacity_listener(listener):
+    if listener not in KeeperManager.capacity_listeners:
+      KeeperManager.capacity_listeners.append(listener)
+
+  @staticmethod
+  def notify_capacity_released(reason, app):
+    for listener in KeeperManager.capacity_listeners:
+      try:
+        listener(reason, app)
+      except Exception as e:
+        app.logger.error("Failed to notify capacity listener: %s", e)
 
   power_on_init = 0
   powering_on = 1
@@ -683,6 +924,7 @@ class KeeperManager:
       db.update_ip_provision_by_id(ip_provision_id, 0, app)
       db.remove_ip_runner(ip_provision_id, app)
       app.logger.debug("Released IP: %s as %s.", ip_address, status)
+      KeeperManager.notify_capacity_released("pipeline: %s %s" % (pipeline_id, status), app)
   
   @staticmethod
   def release_ip_runner_on_failure(project_id, app):
@@ -693,6 +935,7 @@ class KeeperManager:
       db.update_ip_provision_by_id(ip_provision_id, 0, app)
       db.remove_ip_runner(ip_provision_id, app)
       app.logger.debug("Release IP provision for project: %s as failure", project_id)
+      KeeperManager.notify_capacity_released("project: %s failure" % (project_id,), app)
 
   @staticmethod
   def register_runner(username, project_name, config, app):
@@ -801,7 +1044,7 @@ class KeeperManager:
       req_params["variables[%s]" % (key,)] = value
     app.logger.debug("Trigger legacy pipeline with requested params: %s", req_params)
     merged = {**default, **req_params}
-    resp = requests.post(request_url, data=merged)
+    resp = KeeperManager.send_request('POST', request_url, app, data=merged)
     if resp.status_code >= 400:
       raise KeeperException(resp.status_code, resp.text)
     app.logger.debug("Requested with URL: %s, responed: %s with status code: %s", request_url, resp.text, resp.status_code)
@@ -810,7 +1053,7 @@ class KeeperManager:
   def get_config_variables(project_id, app):
     app.logger.debug("Get config variables with project ID: %s", project_id)
     request_url = "%s/projects/%d/variables" % (KeeperManager.get_gitlab_api_url(), project_id)
-    return KeeperManager.request_gitlab_api(project_id, request_url, app, method="GET")
+    return list(KeeperManager.paginate_gitlab_api(project_id, request_url, app))
 
   @staticmethod
   def add_config_variable(project_id, key, value, app):
@@ -824,11 +1067,26 @@ class KeeperManager:
     request_url = "%s/projects/%d/variables/%s" % (KeeperManager.get_gitlab_api_url(), project_id, key)
     return KeeperManager.request_gitlab_api(project_id, request_url, app, params={"value": value}, method="PUT")
 
+  @staticmethod
+  def resolve_commit_sha(project_id, ref, app):
+    if re.fullmatch(r"[0-9a-f]{40}", ref):
+      return ref
+    request_url = "%s/projects/%d/repository/commits/%s" % (KeeperManager.get_gitlab_api_url(), project_id, parse.quote(ref, safe=""))
+    return KeeperManager.request_gitlab_api(project_id, request_url, app, method='GET')["id"]
+
   @staticmethod
   def get_repository_raw_file(project_id, file_path, branch, app):
     app.logger.debug("Get file %s from repository with project ID: %s", file_path, project_id)
-    request_url = "%s/projects/%d/repository/files/%s/raw?ref=%s" % (KeeperManager.get_gitlab_api_url(), project_id, file_path, branch)
-    return KeeperManager.request_gitlab_api(project_id, request_url, app, method="GET", resp_raw=True)
+    sha = KeeperManager.resolve_commit_sha(project_id, branch, app)
+    key = (int(project_id), parse.unquote(file_path), sha)
+    content = ContentCache.get(key, app)
+    if content is not None:
+      app.logger.debug("Got file %s at commit: %s from content cache.", file_path, sha)
+      return content
+    request_url = "%s/projects/%d/repository/files/%s/raw?ref=%s" % (KeeperManager.get_gitlab_api_url(), project_id, file_path, sha)
+    content = KeeperManager.request_gitlab_api(project_id, request_url, app, method="GET", resp_raw=True)
+    ContentCache.set(key, content, app)
+    return content
 
   @staticmethod
   def manipulate_file_to_repository(action, project_id, branch, username, email, file_path, content, app):
@@ -862,22 +1120,50 @@ class KeeperManager:
     return current_variables
 
   @staticmethod
-  def resolve_config_variables(config_project_id, target_project_id, file_path, branch, app):
+  def plan_config_variables(last_variables, current_variables):
+    plan = VariablePlan()
+    last = {v["key"]: v.get("value") for v in last_variables}
+    for key, value in current_variables.items():
+      if key not in last:
+        plan.to_add[key] = value
+      elif last[key] != value:
+        plan.to_update[key] = value
+      else:
+        plan.unchanged.append(key)
+    plan.to_delete = [key for key in last if key not in current_variables]
+    return plan
+
+  @staticmethod
+  def apply_config_variable_plan(project_id, plan, app):
+    operations = [("update", k, v) for k, v in plan.to_update.items()]
+    operations += [("delete", k, None) for k in plan.to_delete]
+    operations += [("add", k, v) for k, v in plan.to_add.items()]
+    def callback(operation):
+      action, key, value = operation
+      try:
+        if action == "update":
+          KeeperManager.update_config_variable(project_id, key, value, app)
+        elif action == "delete":
+          KeeperManager.delete_config_variable(project_id, key, app)
+        else:
+          KeeperManager.add_config_variable(project_id, key, value, app)
+      except KeeperException as e:
+        return e
+    workers = get_optional_info("SYNC_CONF", {}).get("WORKERS", 4)
+    errors = [e for e in ConcurrentUtil.map(app, callback, operations, workers) if e]
+    if errors:
+      raise KeeperException(errors[0].code, "Failed %d of %d config variable operations, first error: %s" % (len(errors), len(operations), errors[0].message))
+
+  @staticmethod
+  def resolve_config_variables(config_project_id, target_project_id, file_path, branch, app, dry_run=False):
     last_variables = KeeperManager.get_config_variables(target_project_id, app)
     current_variables = KeeperManager.resolve_key_value_pairs_from_file(config_project_id, branch, file_path, app)
     app.logger.debug("Current config variables: %s", current_variables)
-    for current_key in list(current_variables.keys()):
-      current_value = current_variables[current_key]
-      for index, last_config in enumerate(last_variables):
-        if last_config["key"] == current_key:
-          KeeperManager.update_config_variable(target_project_id, current_key, current_value, app)
-          del current_variables[current_key]
-          last_variables.pop(index)
-          break
-    for config in last_variables:
-      KeeperManager.delete_config_variable(target_project_id, config["key"], app)
-    for key, value in current_variables.items():
-      KeeperManager.add_config_variable(target_project_id, key, value, app)
+    plan = KeeperManager.plan_config_variables(last_variables, current_variables)
+    app.logger.debug("Resolved %s with project ID: %s", plan, target_project_id)
+    if not dry_run:
+      KeeperManager.apply_config_variable_plan(target_project_id, plan, app)
+    return plan
 
   @staticmethod
   def retrieve_files_from_repo(username, project_name, file_path, branch, app):
@@ -891,31 +1177,60 @@ class KeeperManager:
     actions = [{"action": action, "file_path": file_path, "content": content}]
     return KeeperManager.commit_files(project.project_id, branch, commit_message, actions, app)
 
+  @staticmethod
+  def get_trace_conf():
+    conf = {"WORKERS": 4, "MAX_BYTES": 1048576, "KEEP_TAIL": True, "CHUNK_SIZE": 65536, "OVERLAP": 4096}
+    conf.update(get_optional_info("TRACE_CONF", {}))
+    return conf
+
   @staticmethod
   def get_pipeline_failed_jobs(project_id, pipeline_id, app):
     app.logger.debug("Get pipeline: %s for failed jobs log trace with project ID: %d", pipeline_id, project_id)
     request_url = "%s/projects/%d/pipelines/%d/jobs" % (KeeperManager.get_gitlab_api_url(), project_id, pipeline_id)
-    r = KeeperManager.request_gitlab_api(project_id, request_url, app, method="GET", params={"scope[]": "failed"})
-    failed_pipeline_jobs = []
-    for job in r:
-      stage = job["stage"]
-      name = job["name"]
-      job_id = job["id"]
-      trace = KeeperManager.download_job_log_trace(project_id, job_id, app)
-      user_info = job["user"]["username"]
-      job_log = PipelineJobLog(pipeline_id, stage, name, job_id, trace, user_info)
-      failed_pipeline_jobs.append(job_log)
-    return failed_pipeline_jobs
-
-  @staticmethod
-  def download_job_log_trace(project_id, job_id, app):
+    jobs = list(KeeperManager.paginate_gitlab_api(project_id, request_url, app, params={"scope[]": "failed"}))
+    def callback(job):
+      try:
+        scanner = KeeperManager.get_judgement_scanner("%s|%s" % (job["stage"], job["name"]), app)
+      except KeeperException:
+        scanner = None
+      trace = KeeperManager.download_job_log_trace(project_id, job["id"], app, scanner=scanner)
+      matched = scanner.matched if scanner else None
+      return PipelineJobLog(pipeline_id, job["stage"], job["name"], job["id"], trace, job["user"]["username"], matched)
+    return ConcurrentUtil.map(app, callback, jobs, KeeperManager.get_trace_conf()["WORKERS"])
+
+  @staticmethod
+  def download_job_log_trace(project_id, job_id, app, scanner=None):
     app.logger.debug("Download from job: %d trace with project ID: %d", job_id, project_id)
     request_url = "%s/projects/%d/jobs/%d/trace" % (KeeperManager.get_gitlab_api_url(), project_id, job_id)
-    return KeeperManager.request_gitlab_api(project_id, request_url, app, method="GET", resp_raw=True)
+    token = KeeperManager.resolve_principle_token(project_id, 'project_id', app)
+    conf = KeeperManager.get_trace_conf()
+    buffer = TraceBuffer(conf["MAX_BYTES"], conf["KEEP_TAIL"])
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    buffering = True
+    scanning = scanner is not None
+    resp = KeeperManager.send_gitlab_request(token, request_url, app, method='GET', stream=True)
+    try:
+      for chunk in resp.iter_content(chunk_size=conf["CHUNK_SIZE"]):
+        buffering = buffering and buffer.append(chunk)
+        if scanning:
+          scanning = not scanner.feed(decoder.decode(chunk))
+        if not buffering and not scanning:
+          break
+      if scanning:
+        scanner.feed(decoder.decode(b"", final=True))
+        scanner.finish()
+    except requests.RequestException as e:
+      raise KeeperException(503, "Failed to download trace of job: %d with error: %s" % (job_id, e))
+    finally:
+      resp.close()
+    if buffer.truncated:
+      app.logger.debug("Trace of job: %d was truncated to %d bytes.", job_id, buffer.size)
+    return buffer.text()
 
   @staticmethod
   def create_job_log_judgement(rule_name, rule, app):
     db.insert_job_log_judgement(rule_name, rule, app)
+    JudgementEngine.invalidate()
     app.logger.debug("Created job log judgement: %s with rule: %s", rule_name, rule)
 
   @staticmethod
@@ -926,6 +1241,7 @@ class KeeperManager:
   @staticmethod
   def remove_job_log_judgement(rule_name, app):
     db.delete_job_log_judgement(rule_name, app)
+    JudgementEngine.invalidate()
     app.logger.debug("Deleted job log judgement: %s", rule_name)
 
   @staticmethod
@@ -935,26 +1251,36 @@ class KeeperManager:
       raise KeeperException(404, "None of job log judgement rule for name: %s found, create one first." %(rule_name,))
     return JobLogJudgementRule(r["rule_name"], r["rule"])
 
+  @staticmethod
+  def get_judgement_scanner(rule_name, app):
+    rule = JudgementEngine.get_rule(rule_name, app)
+    if rule is None:
+      return None
+    if isinstance(rule, Exception):
+      raise KeeperException(400, "Invalid job log judgement rule: %s with error: %s" % (rule_name, rule))
+    return JudgementScanner(rule, KeeperManager.get_trace_conf()["OVERLAP"])
+
   @staticmethod
   def match_job_log_by_judgement(pipeline_job_logs, app):
     for job_log in pipeline_job_logs:
       rule_name = "%s|%s" % (job_log.stage, job_log.job_name)
-      judgement = KeeperManager.get_job_log_judgement(rule_name, app)
-      try:
-        p = re.compile(judgement.rule, re.M)
-        if re.search(p, job_log.trace):
-          app.logger.debug("Bypass for DevOps issue as matched job log by rule: %s with characters: %s", rule_name, judgement.rule)
-          continue # Passed for issue with DevOps.
-        payload = {
-          "assignee": job_log.username,
-          "job_name": job_log.job_name,
-          "pipeline_id": job_log.pipeline_id,
-        }
-        app.logger.debug("Return for user: %s issue as it does not matched job log by reserved judgement.", payload["assignee"])
-        return True, payload  # Return matched flag for openning issue to assignee.
-      except Exception as e:
-        app.logger.error("Failed to match job log by reserved judgement: %s", e)
-        raise KeeperException(400, e)
+      matched = job_log.matched
+      if matched is None:
+        scanner = KeeperManager.get_judgement_scanner(rule_name, app)
+        if scanner is None:
+          app.logger.debug("Bypass for job: %s as none of job log judgement rule found by name: %s", job_log.job_name, rule_name)
+          continue
+        matched = scanner.scan(job_log.trace, KeeperManager.get_trace_conf()["CHUNK_SIZE"])
+      if matched:
+        app.logger.debug("Bypass for DevOps issue as matched job log by rule: %s", rule_name)
+        continue # Passed for issue with DevOps.
+      payload = {
+        "assignee": job_log.username,
+        "job_name": job_log.job_name,
+        "pipeline_id": job_log.pipeline_id,
+      }
+      app.logger.debug("Return for user: %s issue as it does not matched job log by reserved judgement.", payload["assignee"])
+      return True, payload  # Return matched flag for openning issue to assignee.
     return False, None
 
   @staticmethod
@@ -980,20 +1306,74 @@ class KeeperManager:
   @staticmethod
   def create_evaluation(evaluation, app):
     db.insert_evaluation(evaluation.category, evaluation.standard, evaluation.level, evaluation.suggestion, app)
+    KeeperManager.get_evaluation_cache().invalidate(evaluation.category)
     app.logger.debug("Successful created evaluation: %s", evaluation)
 
   @staticmethod
   def remove_evaluation(category, app):
     db.delete_evaluation(category, app)
+    KeeperManager.get_evaluation_cache().invalidate(category)
     app.logger.debug("Successful removed evaluation by category: %s", category)
 
+  @staticmethod
+  def get_evaluation_cache():
+    return TTLCache.named("evaluation", maxsize=256, ttl=3600, negative_ttl=60)
+
+  @staticmethod
+  def get_compiled_evaluation(category, app):
+    cache = KeeperManager.get_evaluation_cache()
+    cached = cache.get(category, TTLCache.missing)
+    if cached is TTLCache.missing:
+      try:
+        evaluation = KeeperManager.get_evaluation(category, app)
+        cached = (evaluation, re.compile(evaluation.standard, re.M))
+        cache.set(category, cached)
+      except KeeperException as e:
+        cached = e
+        cache.set(category, cached, ttl=cache.negative_ttl)
+    if isinstance(cached, KeeperException):
+      raise KeeperException(cached.code, cached.message)
+    return cached
+
   @staticmethod
   def evaluate_content(category, content, app):
     try:
-      evaluation = KeeperManager.get_evaluation(category, app)
-      p = re.compile(evaluation.standard, re.M)
-      if re.search(p, content):
+      evaluation, p = KeeperManager.get_compiled_evaluation(category, app)
+      if p.search(content):
         return True, evaluation
     except Exception as e:
       app.logger.error("Failed to evaluate content with error: %s", e)
-    return False, None
\ No newline at end of file
+    return False, None
+
+  @staticmethod
+  def get_repository_tree(project_id, path, branch, app):
+    app.logger.debug("Get repository tree of path: %s at branch: %s with project ID: %s", path, branch, project_id)
+    request_url = "%s/projects/%d/repository/tree" % (KeeperManager.get_gitlab_api_url(), project_id)
+    params = {"path": path, "ref": branch, "recursive": True}
+    return KeeperManager.paginate_gitlab_api(project_id, request_url, app, params=params)
+
+  @staticmethod
+  def get_evaluation_conf():
+    conf = {"WORKERS": 4, "MAX_FILES": 500}
+    conf.update(get_optional_info("EVALUATION_CONF", {}))
+    return conf
+
+  @staticmethod
+  def evaluate_files(project_id, category, file_paths, branch, app):
+    # Resolve the branch once for the whole batch, a SHA is passed through by get_repository_raw_file.
+    try:
+      sha = KeeperManager.resolve_commit_sha(project_id, branch, app)
+    except KeeperException as e:
+      return [{"file_path": file_path, "evaluated": False, "error": e.message} for file_path in file_paths]
+    def callback(file_path):
+      result = {"file_path": file_path, "evaluated": False}
+      try:
+        content = KeeperManager.get_repository_raw_file(project_id, parse.quote(file_path, safe=""), sha, app)
+        evaluated, evaluation = KeeperManager.evaluate_content(category, content, app)
+        if evaluated:
+          result.update(evaluated=True, category=evaluation.category, standard=evaluation.standard,
+            level=evaluation.level, suggestion=evaluation.suggestion)
+      except KeeperException as e:
+        result["error"] = e.message
+      return result
+    return ConcurrentUtil.map(app, callback, file_paths, KeeperManager.get_evaluation_conf()["WORKERS"])
\ No newline at end of file
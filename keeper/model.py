@@ -52,6 +52,49 @@ class Runner:
   def __str__(self):
     return "runner_id: %s, runner_name: %s" % (self.runner_id, self.runner_name)
 
+class VMRequest:
+  __slots__ = 'vm_name', 'username', 'project_id', 'project_name', 'status', 'ip_provision_id', 'pipeline_id', 'vm_conf'
+  def __init__(self, vm_name, username, project_id, project_name, status, ip_provision_id, pipeline_id, vm_conf):
+    self.vm_name = vm_name
+    self.username = username
+    self.project_id = project_id
+    self.project_name = project_name
+    self.status = status
+    self.ip_provision_id = ip_provision_id
+    self.pipeline_id = pipeline_id
+    self.vm_conf = vm_conf
+
+  def __str__(self):
+    return "vm_name: %s, project_name: %s, pipeline_id: %s, ip_provision_id: %s" % (self.vm_name, self.project_name, self.pipeline_id, self.ip_provision_id)
+
+class ReleaseRequest:
+  __slots__ = 'action', 'operator', 'release_repo', 'release_branch', 'category', 'version_info', 'project_name', 'version'
+  def __init__(self, action, operator, release_repo, release_branch, category, version_info, project_name="N/A", version="N/A"):
+    self.action = action
+    self.operator = operator
+    self.release_repo = release_repo
+    self.release_branch = release_branch
+    self.category = category
+    self.version_info = version_info
+    self.project_name = project_name
+    self.version = version
+
+  def __str__(self):
+    return "action: %s, release_repo: %s, release_branch: %s, version: %s" % (self.action, self.release_repo, self.release_branch, self.version)
+
+class IssueRequest:
+  __slots__ = 'username', 'project_name', 'title', 'description', 'label', 'assignee'
+  def __init__(self, username, project_name, title, description="As title.", label="issue", assignee=""):
+    self.username = username
+    self.project_name = project_name
+    self.title = title
+    self.description = description
+    self.label = label
+    self.assignee = assignee
+
+  def __str__(self):
+    return "project_name: %s, title: %s, label: %s, assignee: %s" % (self.project_name, self.title, self.label, self.assignee)
+
 class NoteTemplate:
   __slots__ = 'name', "content"
   def __init__(self, name, content):
@@ -65,6 +108,10 @@ class VMGlobalStatus:
   __slots__ = "id", "name", "provider", "status", "directory"
   @classmethod
   def parse(cls, raw_content, name):
+    return cls.parse_all(raw_content).get(name)
+
+  @classmethod
+  def parse_all(cls, raw_content):
     p = re.compile(r'''
       (?![\-]+\n)
       (?P<id>\w{7})\s+
@@ -73,6 +120,7 @@ class VMGlobalStatus:
       (?P<status>\w+)\s+
       (?P<directory>[\w/-]+)\s+
       (?=\n)''',re.VERBOSE)
+    vms = {}
     try:
       for m in p.finditer(raw_content):
         vm_global_status = VMGlobalStatus()
@@ -82,11 +130,10 @@ class VMGlobalStatus:
         vm_global_status.status = m.group("status")
         vm_global_status.directory = m.group("directory")
         vm_name = vm_global_status.directory[vm_global_status.directory.rindex("/")+1:]
-        if vm_name == name:
-          return vm_global_status
+        vms.setdefault(vm_name, vm_global_status)
     except Exception:
       pass
-    return None
+    return vms
 
   def __str__(self):
     return "id: {}, name: {}, provider: {}, status: {}, directory: {}".format(
@@ -106,40 +153,52 @@ class ProjectRunner:
     return "Project runner - project ID: %d, runner ID: %d" % (self.project_id, self.runner_id)
 
 class IPProvision:
-  __slots__ = "id", "ip_address"
+  __slots__ = "id", "ip_address", "host_name"
   
-  def __init__(self, id, ip_address):
+  def __init__(self, id, ip_address, host_name=None):
     self.id = id
     self.ip_address = ip_address
+    self.host_name = host_name
   
   def __str__(self):
     return "IP provision - ID: %d, IP address: %s" % (self.id, self.ip_address)
 
 class PipelineTask:
-  __slots__ = "id", "priority"
+  __slots__ = "id", "priority", "project_id", "enqueued_at", "lease_token", "attempts"
 
-  def __init__(self, id, priority):
+  def __init__(self, id, priority, project_id=None, enqueued_at=None, lease_token=None, attempts=0):
     self.id = id
     self.priority = priority
+    self.project_id = project_id
+    self.enqueued_at = enqueued_at
+    self.lease_token = lease_token
+    self.attempts = attempts
+
+  def sort_key(self):
+    return (self.priority, self.enqueued_at or 0, self.id)
 
   def __lt__(self, other):
-    return self.priority < other.priority
+    return self.sort_key() < other.sort_key()
 
   def __gt__(self, other):
-    return self.priority > other.priority
+    return self.sort_key() > other.sort_key()
 
   def __eq__(self, other):
-    return self.priority == other.priority
+    return isinstance(other, PipelineTask) and self.sort_key() == other.sort_key()
+
+  def __hash__(self):
+    return hash(self.id)
 
 class PipelineJobLog:
-  __slots__ = "pipeline_id", "stage", "job_name", "job_id", "trace", "username"
-  def __init__(self, pipeline_id, stage, job_name, job_id, trace, username):
+  __slots__ = "pipeline_id", "stage", "job_name", "job_id", "trace", "username", "matched"
+  def __init__(self, pipeline_id, stage, job_name, job_id, trace, username, matched=None):
     self.pipeline_id = pipeline_id
     self.stage = stage
     self.job_name = job_name
     self.job_id = job_id
     self.trace = trace
     self.username = username
+    self.matched = matched
 
   def __str__(self):
     return "Got log trace from pipeline ID: %d, stage: %s, job name: %s, job ID: %d for username: %s" % (self.pipeline_id, self.stage, self.job_name, self.job_id, self.username)
@@ -162,4 +221,42 @@ class Evaluation:
     self.suggestion = suggestion
   
   def __str__(self):
-    return "Got evaluation by category: %s with standard: %s, level: %d, suggestion: %s" % (self.category, self.standard, self.level, self.suggestion)
\ No newline at end of file
+    return "Got evaluation by category: %s with standard: %s, level: %d, suggestion: %s" % (self.category, self.standard, self.level, self.suggestion)
+
+class VariablePlan:
+  __slots__ = "to_add", "to_update", "to_delete", "unchanged"
+  def __init__(self):
+    self.to_add = {}
+    self.to_update = {}
+    self.to_delete = []
+    self.unchanged = []
+
+  def to_dict(self):
+    return {
+      "add": sorted(self.to_add.keys()),
+      "update": sorted(self.to_update.keys()),
+      "delete": sorted(self.to_delete),
+      "unchanged": sorted(self.unchanged),
+    }
+
+  def __str__(self):
+    return "Variable plan - add: %d, update: %d, delete: %d, unchanged: %d" % (len(self.to_add), len(self.to_update), len(self.to_delete), len(self.unchanged))
+
+class CommandResult:
+  __slots__ = "command", "exit_code", "stdout", "stderr", "truncated", "timed_out", "cancelled", "duration"
+  def __init__(self, command, exit_code, stdout, stderr, truncated=False, timed_out=False, cancelled=False, duration=0):
+    self.command = command
+    self.exit_code = exit_code
+    self.stdout = stdout
+    self.stderr = stderr
+    self.truncated = truncated
+    self.timed_out = timed_out
+    self.cancelled = cancelled
+    self.duration = duration
+
+  @property
+  def ok(self):
+    return self.exit_code == 0 and not self.timed_out and not self.cancelled
+
+  def __str__(self):
+    return "Command: %s exited with code: %s in %.3fs, timed out: %s, cancelled: %s" % (self.command, self.exit_code, self.duration, self.timed_out, self.cancelled)
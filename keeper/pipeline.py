@@ -0,0 +1,227 @@
+import threading
+import time
+import uuid
+
+from keeper import db
+from keeper import get_optional_info
+from keeper.manager import KeeperManager, KeeperException
+from keeper.model import PipelineTask
+from keeper.policy import SchedulingPolicy
+from keeper.util import LatencyStats
+
+class PipelineQueue:
+  default_conf = {
+    "VISIBILITY_TIMEOUT": 300,
+  }
+
+  @classmethod
+  def get_conf(cls):
+    conf = dict(cls.default_conf)
+    conf.update(get_optional_info("PIPELINE_QUEUE_CONF", {}))
+    return conf
+
+  @classmethod
+  def enqueue(cls, pipeline_id, project_id, priority, app):
+    inserted = db.enqueue_pipeline(pipeline_id, project_id, priority, time.time(), app) > 0
+    if inserted:
+      app.logger.debug("Pipeline: %d of project: %d has been queued with priority: %d.", pipeline_id, project_id, priority)
+    else:
+      app.logger.debug("Pipeline: %d has already been queued.", pipeline_id)
+    return inserted
+
+  @classmethod
+  def lease(cls, app, visibility_timeout=None, policy=None):
+    return next(cls.lease_all(app, visibility_timeout=visibility_timeout, policy=policy), None)
+
+  @classmethod
+  def lease_all(cls, app, visibility_timeout=None, policy=None):
+    if visibility_timeout is None:
+      visibility_timeout = cls.get_conf()["VISIBILITY_TIMEOUT"]
+    if policy is None:
+      policy = SchedulingPolicy.current()
+    now = time.time()
+    # Projects already holding a runner are filtered in SQL, the rest is read and ordered once per pass.
+    tasks = [PipelineTask(r["pipeline_id"], r["priority"], r["project_id"], r["enqueued_at"], attempts=r["attempts"])
+      for r in db.get_visible_pipelines(now)]
+    running = {r["project_id"]: r["running"] for r in db.get_running_pipeline_counts()}
+    for task in policy.order(tasks, now, running):
+      # Another worker may win the same row, fall through to the next candidate.
+      lease_token = uuid.uuid4().hex
+      leased_at = time.time()
+      if db.lease_pipeline(task.id, lease_token, leased_at, leased_at + visibility_timeout, app) > 0:
+        task.lease_token = lease_token
+        task.attempts += 1
+        yield task
+
+  @classmethod
+  def ack(cls, task, app):
+    db.ack_pipeline(task.id, task.lease_token, app)
+
+  @classmethod
+  def release(cls, task, app):
+    db.release_pipeline(task.id, task.lease_token, app)
+
+  @classmethod
+  def remove(cls, pipeline_id, app):
+    db.remove_pipeline(pipeline_id, app)
+
+  @classmethod
+  def depth(cls):
+    return len(db.get_queued_pipelines())
+
+  @classmethod
+  def list(cls):
+    now = time.time()
+    policy = SchedulingPolicy.current()
+    rows = {r["pipeline_id"]: r for r in db.get_queued_pipelines()}
+    tasks = [PipelineTask(r["pipeline_id"], r["priority"], r["project_id"], r["enqueued_at"], attempts=r["attempts"]) for r in rows.values()]
+    running = {r["project_id"]: r["running"] for r in db.get_running_pipeline_counts()}
+    ordered = policy.order(tasks, now, running)
+    capped = sorted(set(tasks) - set(ordered))
+    pipelines = []
+    for position, task in enumerate(ordered + capped, 1):
+      r = rows[task.id]
+      pipelines.append({
+        "position": position,
+        "pipeline_id": task.id,
+        "project_id": task.project_id,
+        "priority": task.priority,
+        "attempts": task.attempts,
+        "waiting_seconds": round(now - task.enqueued_at, 3),
+        "leased": r["leased_until"] is not None and r["leased_until"] >= now,
+        "capped": policy.is_capped(task.project_id, running),
+      })
+    return pipelines
+
+class PipelineDispatcher:
+  default_conf = {
+    "FALLBACK_INTERVAL": 30,
+    "INFLIGHT_SECONDS": 120,
+  }
+  condition = threading.Condition()
+  signaled_at = None
+  thread = None
+  inflight = {}
+  counters = {"signals": 0, "passes": 0, "retried": 0, "dropped": 0}
+  latency = LatencyStats()
+
+  @classmethod
+  def get_conf(cls):
+    conf = dict(cls.default_conf)
+    conf.update(get_optional_info("PIPELINE_DISPATCH_CONF", {}))
+    return conf
+
+  @classmethod
+  def notify(cls, reason=None, app=None):
+    with cls.condition:
+      if cls.signaled_at is None:
+        cls.signaled_at = time.time()
+      cls.counters["signals"] += 1
+      cls.condition.notify()
+    if app is not None:
+      app.logger.debug("Pipeline dispatcher signaled for %s.", reason)
+
+  @classmethod
+  def ensure_started(cls, app):
+    with cls.condition:
+      if cls.thread is not None and cls.thread.is_alive():
+        return
+      cls.thread = threading.Thread(target=cls.run, args=(app,), name="pipeline-dispatcher", daemon=True)
+      cls.thread.start()
+
+  @classmethod
+  def run(cls, app):
+    while True:
+      with app.app_context():
+        interval = cls.get_conf()["FALLBACK_INTERVAL"]
+      with cls.condition:
+        if cls.signaled_at is None:
+          cls.condition.wait(interval)
+        signaled_at, cls.signaled_at = cls.signaled_at, None
+      with app.app_context():
+        try:
+          cls.dispatch(app, signaled_at)
+        except Exception as e:
+          app.logger.error("Pipeline dispatcher failed: %s", e)
+
+  @classmethod
+  def get_free_slots(cls, app):
+    # Retried pipelines claim their IP only when their webhook arrives, count them until then.
+    now = time.time()
+    timeout = cls.get_conf()["INFLIGHT_SECONDS"]
+    with cls.condition:
+      inflight = dict(cls.inflight)
+    for pipeline_id, retried_at in inflight.items():
+      if now - retried_at > timeout or db.get_ip_provision_by_pipeline(pipeline_id):
+        with cls.condition:
+          cls.inflight.pop(pipeline_id, None)
+    with cls.condition:
+      pending = len(cls.inflight)
+    return KeeperManager.get_free_capacity(app) - pending
+
+  @classmethod
+  def dispatch(cls, app, signaled_at=None):
+    skipped = []
+    policy = SchedulingPolicy.current()
+    with cls.condition:
+      cls.counters["passes"] += 1
+    slots = cls.get_free_slots(app)
+    if slots <= 0:
+      return
+    projects = set()
+    try:
+      for pipeline_task in PipelineQueue.lease_all(app, policy=policy):
+        pipeline_id = pipeline_task.id
+        app.logger.debug("Got pipeline ID: %d from queue with priority: %d", pipeline_id, pipeline_task.priority)
+        if pipeline_task.project_id in projects:
+          # A project holds one runner at a time, its next pipeline waits for the one just retried.
+          skipped.append(pipeline_task)
+          continue
+        try:
+          # Free capacity, warm VMs included, is already counted in slots.
+          KeeperManager.check_ip_runner_reservation(pipeline_task.project_id, app)
+        except KeeperException:
+          skipped.append(pipeline_task)
+          app.logger.debug("Pipeline: %d was hanged up as the project pipeline jobs has been reserved by others.", pipeline_id)
+          continue
+        app.logger.debug("Pipeline: %d will be retried as the project pipeline jobs has been released.", pipeline_id)
+        try:
+          KeeperManager.retry_pipeline(pipeline_task.project_id, pipeline_id, app)
+          PipelineQueue.ack(pipeline_task, app)
+          policy.record(pipeline_task, time.time())
+          with cls.condition:
+            cls.inflight[pipeline_id] = time.time()
+          slots -= 1
+          projects.add(pipeline_task.project_id)
+          cls._retried(signaled_at)
+          if slots <= 0:
+            break
+        except KeeperException as e:
+          app.logger.error("Failed to retry pipeline: %d, %s", pipeline_id, e)
+          if 400 <= e.code < 500 and e.code != 429:
+            PipelineQueue.ack(pipeline_task, app)
+            with cls.condition:
+              cls.counters["dropped"] += 1
+          else:
+            skipped.append(pipeline_task)
+    finally:
+      for pipeline_task in skipped:
+        PipelineQueue.release(pipeline_task, app)
+
+  @classmethod
+  def _retried(cls, signaled_at):
+    if signaled_at is not None:
+      cls.latency.add(time.time() - signaled_at)
+    with cls.condition:
+      cls.counters["retried"] += 1
+
+  @classmethod
+  def stats(cls):
+    with cls.condition:
+      counters = dict(cls.counters)
+      running = cls.thread is not None and cls.thread.is_alive()
+      inflight = len(cls.inflight)
+    return dict(counters, running=running, inflight=inflight, depth=PipelineQueue.depth(), policy=SchedulingPolicy.current().name,
+      dispatch_latency=cls.latency.summary())
+
+KeeperManager.add_capacity_listener(PipelineDispatcher.notify)
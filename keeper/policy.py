@@ -0,0 +1,240 @@
+import json
+import threading
+from collections import deque
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+
+from keeper import get_optional_info
+from keeper.model import PipelineTask
+
+class SchedulingPolicy:
+  name = None
+  policies = {}
+  lock = threading.Lock()
+  current_policy = None
+  default_conf = {
+    "POLICY": "strict",
+    "AGING_SECONDS": 600,
+    "FAIR_SHARE_WINDOW": 3600,
+    "WEIGHTS": {},
+    # Runners a project may hold at once: 0 blocks it, a negative cap falls back to DEFAULT_CAP
+    # and a negative DEFAULT_CAP leaves it uncapped. An IP runner reservation is held per
+    # project, so the default is one.
+    "PROJECT_CAPS": {},
+    "DEFAULT_CAP": 1,
+  }
+
+  def __init__(self, conf):
+    self.conf = conf
+    self.weights = {int(k): v for k, v in conf["WEIGHTS"].items()}
+    self.caps = {int(k): v for k, v in conf["PROJECT_CAPS"].items()}
+
+  @classmethod
+  def register(cls, policy_cls):
+    cls.policies[policy_cls.name] = policy_cls
+    return policy_cls
+
+  @classmethod
+  def get_conf(cls):
+    conf = dict(cls.default_conf)
+    conf.update(get_optional_info("SCHEDULING_CONF", {}))
+    return conf
+
+  @classmethod
+  def create(cls, name, conf=None):
+    conf = dict(cls.default_conf, **(conf or {}))
+    if name not in cls.policies:
+      raise ValueError("Unknown scheduling policy: %s, expected one of %s." % (name, ", ".join(sorted(cls.policies))))
+    return cls.policies[name](conf)
+
+  @classmethod
+  def current(cls):
+    conf = cls.get_conf()
+    with cls.lock:
+      if cls.current_policy is None or cls.current_policy.conf != conf:
+        cls.current_policy = cls.create(conf["POLICY"], conf)
+      return cls.current_policy
+
+  def get_cap(self, project_id):
+    cap = self.caps.get(project_id, -1)
+    return cap if cap >= 0 else self.conf["DEFAULT_CAP"]
+
+  def is_capped(self, project_id, running):
+    cap = self.get_cap(project_id)
+    return cap >= 0 and running.get(project_id, 0) >= cap
+
+  def order(self, tasks, now, running):
+    eligible = [t for t in tasks if not self.is_capped(t.project_id, running)]
+    return sorted(eligible, key=lambda t: self.rank(t, now, running))
+
+  def rank(self, task, now, running):
+    return task.sort_key()
+
+  def record(self, task, now):
+    pass
+
+@SchedulingPolicy.register
+class StrictPriorityPolicy(SchedulingPolicy):
+  name = "strict"
+
+@SchedulingPolicy.register
+class AgingPriorityPolicy(SchedulingPolicy):
+  name = "aging"
+
+  def rank(self, task, now, running):
+    waited = max(0, now - (task.enqueued_at or now))
+    return (task.priority - waited / self.conf["AGING_SECONDS"],) + task.sort_key()[1:]
+
+@SchedulingPolicy.register
+class WeightedFairSharePolicy(SchedulingPolicy):
+  name = "fair"
+
+  def __init__(self, conf):
+    super().__init__(conf)
+    self.history = deque()
+    self.history_lock = threading.Lock()
+
+  def get_weight(self, project_id):
+    return max(self.weights.get(project_id, 1), 0.001)
+
+  def get_usage(self, now):
+    usage = {}
+    with self.history_lock:
+      while self.history and self.history[0][0] < now - self.conf["FAIR_SHARE_WINDOW"]:
+        self.history.popleft()
+      for _, project_id in self.history:
+        usage[project_id] = usage.get(project_id, 0) + 1
+    return usage
+
+  def order(self, tasks, now, running):
+    usage = self.get_usage(now)
+    eligible = [t for t in tasks if not self.is_capped(t.project_id, running)]
+    def rank(task):
+      share = (usage.get(task.project_id, 0) + running.get(task.project_id, 0)) / self.get_weight(task.project_id)
+      return (share,) + task.sort_key()
+    return sorted(eligible, key=rank)
+
+  def record(self, task, now):
+    with self.history_lock:
+      self.history.append((now, task.project_id))
+
+class SchedulingSimulator:
+  # Same as the default of project.priority for projects unknown to the database.
+  default_priority = 3
+
+  def __init__(self, policy, capacity, default_duration=600):
+    self.policy = policy
+    self.capacity = capacity
+    self.default_duration = default_duration
+
+  @staticmethod
+  def load_records(lines, default_duration=600, priorities=None):
+    # Recorded GitLab webhooks carry no priority, it is looked up per project like the live path does.
+    priorities = priorities or {}
+    pipelines = {}
+    for line in lines:
+      line = line.strip()
+      if not line:
+        continue
+      event = json.loads(line)
+      if "object_attributes" in event:
+        attrs = event["object_attributes"]
+        pipeline_id = attrs["id"]
+        project_id = event["project"]["id"]
+        record = pipelines.setdefault(pipeline_id, {
+          "pipeline_id": pipeline_id,
+          "project_id": project_id,
+          "priority": event.get("priority", priorities.get(project_id, SchedulingSimulator.default_priority)),
+          "at": SchedulingSimulator.parse_time(attrs.get("created_at")),
+          "duration": default_duration,
+        })
+        if attrs.get("duration"):
+          record["duration"] = attrs["duration"]
+      else:
+        priority = priorities.get(event.get("project_id"), SchedulingSimulator.default_priority)
+        pipelines.setdefault(event["pipeline_id"], dict({"priority": priority, "duration": default_duration}, **event))
+    records = sorted(pipelines.values(), key=lambda r: (r["at"], r["pipeline_id"]))
+    if records:
+      start = records[0]["at"]
+      for r in records:
+        r["at"] -= start
+    return records
+
+  @staticmethod
+  def parse_time(value):
+    if value is None or isinstance(value, (int, float)):
+      return value or 0
+    for fmt in ("%Y-%m-%d %H:%M:%S %Z", "%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+      try:
+        return datetime.strptime(value, fmt).timestamp()
+      except ValueError:
+        pass
+    raise ValueError("Unsupported time format: %s" % (value,))
+
+  def run(self, records):
+    pending = deque(records)
+    queue = []
+    running = []
+    waits = []
+    now = 0
+    finished_at = 0
+    while pending or queue or running:
+      next_arrival = pending[0]["at"] if pending else None
+      next_finish = min(r[0] for r in running) if running else None
+      if next_finish is not None and (next_arrival is None or next_finish <= next_arrival):
+        now = next_finish
+        running = [r for r in running if r[0] > now]
+        finished_at = now
+      elif next_arrival is not None:
+        now = next_arrival
+        r = pending.popleft()
+        task = PipelineTask(r["pipeline_id"], r["priority"], r["project_id"], r["at"])
+        queue.append((task, r["duration"]))
+      else:
+        break
+      while queue and len(running) < self.capacity:
+        counts = {}
+        for _, project_id in running:
+          counts[project_id] = counts.get(project_id, 0) + 1
+        durations = {t.id: d for t, d in queue}
+        ordered = self.policy.order([t for t, _ in queue], now, counts)
+        if not ordered:
+          break
+        task = ordered[0]
+        queue = [(t, d) for t, d in queue if t.id != task.id]
+        self.policy.record(task, now)
+        waits.append(now - task.enqueued_at)
+        running.append((now + durations[task.id], task.project_id))
+    waits.sort()
+    return {
+      "policy": self.policy.name,
+      "pipelines": len(waits),
+      "makespan": round(finished_at, 3),
+      "throughput_per_hour": round(len(waits) * 3600 / finished_at, 3) if finished_at else 0,
+      "avg_wait": round(sum(waits) / len(waits), 3) if waits else 0,
+      "p95_wait": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0,
+      "max_wait": round(waits[-1], 3) if waits else 0,
+    }
+
+@click.command("simulate-scheduling", help="Replay recorded pipeline webhooks under each scheduling policy.")
+@click.argument("records", type=click.File("r"))
+@click.option("--policy", "policies", multiple=True, help="Policy to simulate, repeatable, defaults to all.")
+@click.option("--capacity", default=None, type=int, help="Concurrent runners, defaults to IP provisions.")
+@click.option("--default-duration", default=600, type=float, help="Pipeline duration when not recorded.")
+@with_appcontext
+def simulate_scheduling_command(records, policies, capacity, default_duration):
+  from keeper import db
+  if capacity is None:
+    capacity = max(1, db.get_db().execute("select count(*) from ip_provision").fetchone()[0])
+  lines = records.readlines()
+  priorities = {r["project_id"]: r["priority"] for r in db.get_project_priorities()}
+  conf = SchedulingPolicy.get_conf()
+  for name in policies or sorted(SchedulingPolicy.policies):
+    simulator = SchedulingSimulator(SchedulingPolicy.create(name, conf), capacity, default_duration)
+    result = simulator.run(SchedulingSimulator.load_records(lines, default_duration, priorities))
+    click.echo(json.dumps(dict(result, capacity=capacity)))
+
+def init_app(app):
+  app.cli.add_command(simulate_scheduling_command)
@@ -0,0 +1,68 @@
+import threading
+
+from keeper import db
+
+class TokenIndex:
+  lock = threading.Lock()
+  users = None
+  projects = None
+
+  @classmethod
+  def _project_key(cls, project_id):
+    try:
+      return int(project_id)
+    except (TypeError, ValueError):
+      return project_id
+
+  @classmethod
+  def _ensure_loaded(cls):
+    # Lookups work on the returned snapshot, a concurrent refresh only drops the class references.
+    with cls.lock:
+      if cls.users is not None:
+        return cls.users, cls.projects
+      users = {}
+      for r in db.get_user_tokens():
+        users[r["username"]] = (r["user_id"], r["token"])
+      projects = {}
+      for r in db.get_project_tokens():
+        projects.setdefault(r["project_id"], r["token"])
+      cls.users, cls.projects = users, projects
+      return users, projects
+
+  @classmethod
+  def get_user(cls, username):
+    users, _ = cls._ensure_loaded()
+    with cls.lock:
+      if username in users:
+        return users[username]
+    r = db.get_user_info(username)
+    if r is None:
+      return None
+    with cls.lock:
+      users[username] = (r["user_id"], r["token"])
+    return r["user_id"], r["token"]
+
+  @classmethod
+  def get_user_token(cls, username):
+    user = cls.get_user(username)
+    return user[1] if user else None
+
+  @classmethod
+  def get_project_token(cls, project_id):
+    key = cls._project_key(project_id)
+    _, projects = cls._ensure_loaded()
+    with cls.lock:
+      if key in projects:
+        return projects[key]
+    r = db.get_user_token_by_project(project_id)
+    if r is None:
+      return None
+    with cls.lock:
+      projects[key] = r["token"]
+    return r["token"]
+
+  @classmethod
+  def refresh(cls):
+    with cls.lock:
+      cls.users = None
+      cls.projects = None
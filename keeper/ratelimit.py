@@ -0,0 +1,150 @@
+import itertools
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from keeper import get_optional_info
+
+class TokenBucket:
+  def __init__(self, rate, capacity):
+    self.rate = rate
+    self.capacity = capacity
+    self.tokens = capacity
+    self.updated = time.monotonic()
+    self.blocked_until = 0
+
+  def wait_time(self, now):
+    if now < self.blocked_until:
+      return self.blocked_until - now
+    if self.rate <= 0:
+      return 0
+    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+    if self.tokens >= 1:
+      return 0
+    return (1 - self.tokens) / self.rate
+
+  def take(self):
+    if self.rate > 0:
+      self.tokens -= 1
+
+  def block(self, seconds):
+    self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+class RateLimiter:
+  high_priority = 0
+  normal_priority = 1
+  low_priority = 2
+  default_conf = {
+    "HOST_RATE": 20,
+    "HOST_BURST": 40,
+    "TOKEN_RATE": 10,
+    "TOKEN_BURST": 20,
+    "MAX_RETRIES": 5,
+    "DEFAULT_RETRY_AFTER": 1,
+    "MIN_RETRY_AFTER": 0.5,
+  }
+  condition = threading.Condition()
+  buckets = {}
+  waiters = []
+  sequence = itertools.count()
+  counters = {"acquired": 0, "throttled": 0, "throttled_seconds": 0.0, "rate_limited": 0, "max_queue_depth": 0}
+
+  @classmethod
+  def get_conf(cls):
+    conf = dict(cls.default_conf)
+    conf.update(get_optional_info("RATE_LIMIT_CONF", {}))
+    return conf
+
+  @classmethod
+  def _get_buckets(cls, host, principal, conf):
+    keys = [("host", host, conf["HOST_RATE"], conf["HOST_BURST"])]
+    if principal:
+      keys.append(("principal", principal, conf["TOKEN_RATE"], conf["TOKEN_BURST"]))
+    buckets = []
+    for kind, name, rate, burst in keys:
+      if (kind, name) not in cls.buckets:
+        cls.buckets[(kind, name)] = TokenBucket(rate, burst)
+      buckets.append(cls.buckets[(kind, name)])
+    return buckets
+
+  @classmethod
+  def acquire(cls, host, principal, priority=normal_priority):
+    conf = cls.get_conf()
+    ticket = (priority, next(cls.sequence), host, principal)
+    started_at = time.monotonic()
+    with cls.condition:
+      cls.waiters.append(ticket)
+      cls.counters["max_queue_depth"] = max(cls.counters["max_queue_depth"], len(cls.waiters))
+      buckets = cls._get_buckets(host, principal, conf)
+      try:
+        while True:
+          # Calls to the same host leave the queue strictly by priority, then arrival,
+          # skipping callers whose token is paused by a 429 so they do not block the others.
+          now = time.monotonic()
+          ahead = min(t for t in cls.waiters if t[2] == host and (t == ticket or not cls._is_paused(t[3], now)))
+          timeout = 1
+          if ahead == ticket:
+            timeout = max(b.wait_time(now) for b in buckets)
+            if timeout <= 0:
+              for b in buckets:
+                b.take()
+              break
+          cls.condition.wait(timeout)
+      finally:
+        cls.waiters.remove(ticket)
+        cls.condition.notify_all()
+      waited = time.monotonic() - started_at
+      cls.counters["acquired"] += 1
+      if waited > 0.001:
+        cls.counters["throttled"] += 1
+        cls.counters["throttled_seconds"] += waited
+    return waited
+
+  @classmethod
+  def observe(cls, host, principal, resp):
+    conf = cls.get_conf()
+    block_seconds = 0
+    if resp.status_code == 429:
+      # Retry-After: 0 still means rate limited, back off for the minimum before retrying.
+      block_seconds = max(conf["MIN_RETRY_AFTER"], cls._parse_retry_after(resp.headers.get("Retry-After"), conf["DEFAULT_RETRY_AFTER"]))
+    elif resp.headers.get("RateLimit-Remaining") == "0" and resp.headers.get("RateLimit-Reset"):
+      try:
+        block_seconds = max(0, float(resp.headers["RateLimit-Reset"]) - time.time())
+      except ValueError:
+        pass
+    if block_seconds <= 0:
+      return False
+    with cls.condition:
+      if resp.status_code == 429:
+        cls.counters["rate_limited"] += 1
+      # GitLab limits per user when authenticated, so only that caller's bucket is paused.
+      cls._get_buckets(host, principal, conf)[-1].block(block_seconds)
+      cls.condition.notify_all()
+    return resp.status_code == 429
+
+  @classmethod
+  def _is_paused(cls, principal, now):
+    bucket = cls.buckets.get(("principal", principal)) if principal else None
+    return bucket is not None and bucket.blocked_until > now
+
+  @classmethod
+  def _parse_retry_after(cls, value, default):
+    if not value:
+      return default
+    try:
+      return max(0, float(value))
+    except ValueError:
+      pass
+    try:
+      return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+      return default
+
+  @classmethod
+  def stats(cls):
+    with cls.condition:
+      stats = dict(cls.counters)
+      stats["queue_depth"] = len(cls.waiters)
+      stats["throttled_seconds"] = round(stats["throttled_seconds"], 3)
+      return stats
@@ -0,0 +1,236 @@
+from flask import (
+  Blueprint, request, jsonify, current_app, abort
+)
+
+import re
+import threading
+import time
+
+from keeper import db
+from keeper import get_info, get_optional_info
+from keeper.manager import KeeperManager, KeeperException
+from keeper.hosts import HostRegistry
+from keeper.status import GlobalStatusPoller
+from keeper.util import SSHUtil
+from keeper.vm import recycle_vm
+from keeper.warmpool import WarmPool
+
+bp = Blueprint("reconciler", __name__, url_prefix="/api/v1")
+
+class Reconciler:
+  terminal_statuses = ["success", "failed", "canceled", "skipped", "missing"]
+  default_conf = {
+    "INTERVAL": 900,
+    "GRACE_SECONDS": 900,
+    "DRY_RUN": False,
+    "RUNNER_PATTERN": r"-runner-.+-\d+$",
+  }
+  lock = threading.Lock()
+  condition = threading.Condition()
+  thread = None
+  suspects = {}
+  last_report = None
+  counters = {"passes": 0, "leases_released": 0, "ips_released": 0, "runners_removed": 0, "vms_destroyed": 0, "failures": 0}
+
+  @classmethod
+  def get_conf(cls):
+    conf = dict(cls.default_conf)
+    conf.update(get_optional_info("RECONCILE_CONF", {}))
+    return conf
+
+  @classmethod
+  def reconcile(cls, app, dry_run=None):
+    conf = cls.get_conf()
+    if dry_run is None:
+      dry_run = conf["DRY_RUN"]
+    with cls.lock:
+      now = time.time()
+      seen = {}
+      report = {"dry_run": dry_run, "started_at": now, "errors": []}
+      checks = (("leases", cls.check_leases), ("ip_provisions", cls.check_ip_provisions),
+        ("runners", cls.check_runners), ("vms", cls.check_vms))
+      for category, check in checks:
+        report[category] = []
+        try:
+          check(app, conf, report[category], seen, now, dry_run)
+        except Exception as e:
+          app.logger.error("Failed to reconcile %s: %s", category, e)
+          report["errors"].append("%s: %s" % (category, e))
+          # Keep the grace clock of a check that could not run this pass.
+          seen.update({k: v for k, v in cls.suspects.items() if k[0] == category})
+      # Suspects that resolved themselves start a new grace period if they come back.
+      cls.suspects = seen
+      report["duration"] = round(time.time() - now, 3)
+      cls.last_report = report
+      cls._count("passes")
+    return report
+
+  @classmethod
+  def _observe(cls, key, seen, now, conf):
+    first_seen = cls.suspects.get(key, now)
+    seen[key] = first_seen
+    return now - first_seen >= conf["GRACE_SECONDS"]
+
+  @classmethod
+  def _act(cls, app, finding, confirmed, dry_run, action, counter, callback):
+    if not confirmed:
+      finding["action"] = "pending"
+    elif dry_run:
+      finding["action"] = "would be %s" % (action,)
+    else:
+      try:
+        callback()
+        finding["action"] = action
+        cls._count(counter)
+        app.logger.debug("Reconciler %s: %s", action, finding)
+      except Exception as e:
+        finding["action"] = "failed"
+        finding["error"] = str(e)
+        cls._count("failures")
+        app.logger.error("Reconciler failed to act on %s: %s", finding, e)
+    return finding
+
+  @classmethod
+  def check_leases(cls, app, conf, findings, seen, now, dry_run):
+    for r in db.get_ip_runners():
+      project_id = r["project_id"]
+      pipeline_id = r["pipeline_id"]
+      try:
+        status = KeeperManager.get_pipeline(project_id, pipeline_id, app)["status"]
+      except KeeperException as e:
+        if e.code != 404:
+          raise
+        status = "missing"
+      if status not in cls.terminal_statuses:
+        continue
+      confirmed = cls._observe(("leases", pipeline_id), seen, now, conf)
+      finding = {"pipeline_id": pipeline_id, "project_id": project_id, "ip_address": r["ip_address"],
+        "runner_name": r["runner_name"], "status": status, "first_seen": seen[("leases", pipeline_id)]}
+      def callback(r=r, status=status):
+        if r["runner_name"]:
+          recycle_vm(app, r["runner_name"], r["project_id"], r["pipeline_id"], status)
+        else:
+          KeeperManager.release_ip_runner_on_success(r["pipeline_id"], status, app)
+      findings.append(cls._act(app, finding, confirmed, dry_run, "released", "leases_released", callback))
+
+  @classmethod
+  def check_ip_provisions(cls, app, conf, findings, seen, now, dry_run):
+    for r in db.get_orphan_ip_provisions():
+      confirmed = cls._observe(("ip_provisions", r["id"]), seen, now, conf)
+      finding = {"ip_provision_id": r["id"], "ip_address": r["ip_address"], "host": r["host_name"],
+        "first_seen": seen[("ip_provisions", r["id"])]}
+      def callback(r=r):
+        if db.release_orphan_ip_provision(r["id"], app) > 0:
+          KeeperManager.notify_capacity_released("orphan IP: %s" % (r["ip_address"],), app)
+      findings.append(cls._act(app, finding, confirmed, dry_run, "released", "ips_released", callback))
+
+  @classmethod
+  def get_active_suffixes(cls):
+    return tuple("-%d" % (r["pipeline_id"],) for r in db.get_ip_runners())
+
+  @classmethod
+  def check_runners(cls, app, conf, findings, seen, now, dry_run):
+    pattern = re.compile(conf["RUNNER_PATTERN"])
+    known = set(db.get_known_runner_ids())
+    active = cls.get_active_suffixes()
+    checked = set()
+    for p in db.get_runner_projects():
+      project_id = p["project_id"]
+      for r in KeeperManager.iterate_gitlab_runners(project_id, app):
+        description = r.get("description") or ""
+        if r["id"] in checked or r.get("is_shared"):
+          continue
+        checked.add(r["id"])
+        # Runners of pipelines still holding an IP may not be bound in the DB yet.
+        if r["id"] in known or not pattern.search(description) or (active and description.endswith(active)):
+          continue
+        confirmed = cls._observe(("runners", r["id"]), seen, now, conf)
+        finding = {"runner_id": r["id"], "description": description, "project_id": project_id,
+          "first_seen": seen[("runners", r["id"])]}
+        def callback(project_id=project_id, runner_id=r["id"]):
+          KeeperManager.remove_runner(project_id, runner_id, app)
+        findings.append(cls._act(app, finding, confirmed, dry_run, "removed", "runners_removed", callback))
+
+  @classmethod
+  def check_vms(cls, app, conf, findings, seen, now, dry_run):
+    pattern = re.compile(conf["RUNNER_PATTERN"])
+    warm_prefix = "%s-" % (WarmPool.get_conf()["NAME_PREFIX"],)
+    known = set(db.get_known_vm_names())
+    active = cls.get_active_suffixes()
+    hosts = HostRegistry.get_hosts()
+    for vm_dir, (host_name, status) in GlobalStatusPoller.get_all(app).items():
+      host = hosts.get(host_name) if host_name else None
+      dest_path = host["VM_DEST_PATH"] if host and "VM_DEST_PATH" in host else get_info("VM_DEST_PATH")
+      if not status.directory.startswith(dest_path.rstrip("/") + "/"):
+        continue
+      if not pattern.search(vm_dir) and not vm_dir.startswith(warm_prefix):
+        continue
+      if vm_dir in known or (active and vm_dir.endswith(active)):
+        continue
+      confirmed = cls._observe(("vms", host_name, vm_dir), seen, now, conf)
+      finding = {"vm_dir": vm_dir, "vm_id": status.id, "vm_status": status.status, "host": host_name,
+        "first_seen": seen[("vms", host_name, vm_dir)]}
+      def callback(host=host, host_name=host_name, status=status):
+        ssh_conf = HostRegistry.get_ssh_conf(host)
+        try:
+          result = SSHUtil.run(app, "PATH=/usr/local/bin:$PATH vagrant destroy -f %s" % (status.id,), custom_conf=ssh_conf)
+          if not result.ok:
+            raise KeeperException(500, "Failed to destroy VM: %s, %s" % (status.directory, result.stderr or result))
+          SSHUtil.run(app, "rm -rf %s" % (status.directory,), custom_conf=ssh_conf)
+        finally:
+          GlobalStatusPoller.invalidate(host_name)
+      findings.append(cls._act(app, finding, confirmed, dry_run, "destroyed", "vms_destroyed", callback))
+
+  @classmethod
+  def ensure_started(cls, app):
+    with cls.condition:
+      if cls.thread is not None and cls.thread.is_alive():
+        return
+      cls.thread = threading.Thread(target=cls.run, args=(app,), name="reconciler", daemon=True)
+      cls.thread.start()
+
+  @classmethod
+  def run(cls, app):
+    while True:
+      with app.app_context():
+        interval = cls.get_conf()["INTERVAL"]
+      with cls.condition:
+        cls.condition.wait(interval if interval > 0 else None)
+      if interval <= 0:
+        continue
+      with app.app_context():
+        try:
+          cls.reconcile(app)
+        except Exception as e:
+          app.logger.error("Reconciler failed: %s", e)
+
+  @classmethod
+  def _count(cls, name):
+    with cls.condition:
+      cls.counters[name] += 1
+
+  @classmethod
+  def stats(cls):
+    with cls.condition:
+      counters = dict(cls.counters)
+      running = cls.thread is not None and cls.thread.is_alive()
+    report = cls.last_report
+    return dict(counters, running=running, suspects=len(cls.suspects),
+      last_pass=report["started_at"] if report else None,
+      last_errors=report["errors"] if report else [])
+
+@bp.before_app_request
+def start_reconciler():
+  Reconciler.ensure_started(current_app._get_current_object())
+
+@bp.route("/reconcile", methods=["GET", "POST"])
+def reconcile():
+  if request.method == "GET":
+    if Reconciler.last_report is None:
+      return abort(404, "Reconciler has not run yet.")
+    return jsonify(Reconciler.last_report)
+  dry_run = request.args.get("dry_run", "false").lower() == "true"
+  try:
+    return jsonify(Reconciler.reconcile(current_app._get_current_object(), dry_run=dry_run))
+  except KeeperException as e:
+    return abort(e.code, e.message)
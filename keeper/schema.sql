@@ -66,7 +66,9 @@ create table note_template (
 create table ip_provision (
   id integer primary key autoincrement,
   ip_address text unique not null,
-  is_allocated integer default 0
+  is_allocated integer default 0,
+  host_name text,
+  vm_memory integer default 0
 );
 
 create table ip_runner (
@@ -97,4 +99,65 @@ create table evaluation (
   standard text not null,
   level integer not null default 1,
   suggestion text
-);
\ No newline at end of file
+);
+
+create table webhook_event (
+  id integer primary key autoincrement,
+  endpoint text not null,
+  path text not null,
+  query_string text,
+  payload text not null,
+  status integer not null default 0,
+  attempts integer not null default 0,
+  lease_token text,
+  leased_until real,
+  created_at real not null,
+  started_at real,
+  finished_at real,
+  last_error text
+);
+
+create index webhook_event_status on webhook_event (status, id);
+
+create table pipeline_queue (
+  pipeline_id integer primary key,
+  project_id integer not null,
+  priority integer not null default 0,
+  enqueued_at real not null,
+  lease_token text,
+  leased_until real,
+  attempts integer not null default 0
+);
+
+create index pipeline_queue_order on pipeline_queue (priority, enqueued_at);
+
+create index ip_provision_allocated on ip_provision (is_allocated, id);
+
+create table warm_vm (
+  id integer primary key autoincrement,
+  vm_dir text unique not null,
+  vm_box text not null,
+  vm_memory integer not null,
+  ip_provision_id integer not null,
+  status integer not null default 0,
+  alias text unique,
+  pipeline_id integer,
+  created_at real not null,
+  ready_at real,
+  assigned_at real,
+  snapshot_name text
+);
+
+create index warm_vm_profile on warm_vm (vm_box, vm_memory, status);
+
+create index ip_provision_host on ip_provision (host_name, is_allocated);
+
+create table vm_host (
+  vm_dir text primary key,
+  host_name text not null,
+  vm_memory integer not null default 0
+);
+
+create index project_runner_vm on project_runner (vm_id);
+
+create index ip_runner_runner on ip_runner (runner_id);
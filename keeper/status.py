@@ -0,0 +1,142 @@
+import threading
+import time
+
+from keeper import get_optional_info
+from keeper.hosts import HostRegistry
+from keeper.model import VMGlobalStatus
+from keeper.util import SSHUtil, LatencyStats
+
+class GlobalStatusPoller:
+  default_conf = {
+    "INTERVAL": 30,
+    "MAX_STALENESS": 60,
+  }
+  condition = threading.Condition()
+  thread = None
+  index = {}
+  locks = {}
+  generations = {}
+  counters = {"lookups": 0, "refreshes": 0, "refresh_failures": 0, "invalidations": 0}
+  refresh_latency = LatencyStats()
+
+  @classmethod
+  def get_conf(cls):
+    conf = dict(cls.default_conf)
+    conf.update(get_optional_info("GLOBAL_STATUS_CONF", {}))
+    return conf
+
+  @classmethod
+  def get_host_names(cls):
+    if not HostRegistry.is_enabled():
+      return [None]
+    return list(HostRegistry.get_hosts().keys())
+
+  @classmethod
+  def _get_lock(cls, host_name):
+    with cls.condition:
+      if host_name not in cls.locks:
+        cls.locks[host_name] = threading.Lock()
+      return cls.locks[host_name]
+
+  @classmethod
+  def _is_fresh(cls, host_name, max_staleness):
+    with cls.condition:
+      entry = cls.index.get(host_name)
+      if entry is None or entry["generation"] != cls.generations.get(host_name, 0):
+        return False
+      return time.time() - entry["refreshed_at"] <= max_staleness
+
+  @classmethod
+  def refresh(cls, host_name, app, max_staleness=None):
+    # Concurrent lookups for the same host wait for a single global-status run.
+    with cls._get_lock(host_name):
+      if max_staleness is not None and cls._is_fresh(host_name, max_staleness):
+        return True
+      ssh_conf = HostRegistry.get_ssh_conf(HostRegistry.get_hosts().get(host_name)) if host_name else None
+      started_at = time.time()
+      with cls.condition:
+        generation = cls.generations.get(host_name, 0)
+      try:
+        raw_output = SSHUtil.exec_script(app, "PATH=/usr/local/bin:$PATH vagrant", "global-status", "--prune", custom_conf=ssh_conf)
+      except Exception as e:
+        cls._count("refresh_failures")
+        app.logger.error("Failed to refresh global status of host: %s, %s", host_name or "default", e)
+        return False
+      vms = VMGlobalStatus.parse_all(raw_output)
+      cls.refresh_latency.add(time.time() - started_at)
+      with cls.condition:
+        # A create or destroy that raced with this run leaves the entry stale.
+        cls.index[host_name] = {"vms": vms, "refreshed_at": started_at, "generation": generation}
+        cls.counters["refreshes"] += 1
+      app.logger.debug("Refreshed global status of host: %s with %d VMs.", host_name or "default", len(vms))
+      return True
+
+  @classmethod
+  def lookup(cls, vm_dir, host_name, app):
+    conf = cls.get_conf()
+    cls._count("lookups")
+    if not cls._is_fresh(host_name, conf["MAX_STALENESS"]):
+      cls.refresh(host_name, app, max_staleness=conf["MAX_STALENESS"])
+    with cls.condition:
+      entry = cls.index.get(host_name)
+      return entry["vms"].get(vm_dir) if entry else None
+
+  @classmethod
+  def get_all(cls, app, host_name=None):
+    conf = cls.get_conf()
+    vms = {}
+    names = cls.get_host_names()
+    if host_name:
+      # Only registered hosts are polled and indexed, anything else would run on the default host.
+      names = [host_name] if host_name in names else []
+    for name in names:
+      if not cls._is_fresh(name, conf["MAX_STALENESS"]):
+        cls.refresh(name, app, max_staleness=conf["MAX_STALENESS"])
+      with cls.condition:
+        entry = cls.index.get(name)
+        if entry:
+          vms.update({vm_dir: (name, status) for vm_dir, status in entry["vms"].items()})
+    return vms
+
+  @classmethod
+  def invalidate(cls, host_name):
+    with cls.condition:
+      cls.generations[host_name] = cls.generations.get(host_name, 0) + 1
+      cls.counters["invalidations"] += 1
+      cls.condition.notify()
+
+  @classmethod
+  def ensure_started(cls, app):
+    with cls.condition:
+      if cls.thread is not None and cls.thread.is_alive():
+        return
+      cls.thread = threading.Thread(target=cls.run, args=(app,), name="global-status-poller", daemon=True)
+      cls.thread.start()
+
+  @classmethod
+  def run(cls, app):
+    while True:
+      with app.app_context():
+        conf = cls.get_conf()
+        for host_name in cls.get_host_names():
+          try:
+            cls.refresh(host_name, app, max_staleness=conf["INTERVAL"] / 2)
+          except Exception as e:
+            app.logger.error("Failed to poll global status of host: %s, %s", host_name or "default", e)
+      with cls.condition:
+        cls.condition.wait(conf["INTERVAL"])
+
+  @classmethod
+  def _count(cls, name):
+    with cls.condition:
+      cls.counters[name] += 1
+
+  @classmethod
+  def stats(cls):
+    now = time.time()
+    with cls.condition:
+      counters = dict(cls.counters)
+      hosts = {name or "default": {"vms": len(entry["vms"]), "age": round(now - entry["refreshed_at"], 3), "stale": entry["generation"] != cls.generations.get(name, 0)}
+        for name, entry in cls.index.items()}
+      running = cls.thread is not None and cls.thread.is_alive()
+    return dict(counters, hosts=hosts, running=running, refresh_latency=cls.refresh_latency.summary())
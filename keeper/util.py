@@ -2,62 +2,330 @@ from paramiko import SSHClient, AutoAddPolicy
 from scp import SCPClient
 from jinja2 import Environment, PackageLoader, Template
 import os
+import time
+import threading
 from threading import Thread
-from keeper import get_info
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from keeper import get_info, get_optional_info
 from keeper import db
+from keeper.model import CommandResult
 from os import path
 
+class LatencyStats:
+  def __init__(self, samples=1000):
+    self.samples = deque(maxlen=samples)
+    self.lock = threading.Lock()
+
+  def add(self, seconds):
+    with self.lock:
+      self.samples.append(seconds)
+
+  def summary(self):
+    with self.lock:
+      samples = sorted(self.samples)
+    if not samples:
+      return {"count": 0}
+    return {
+      "count": len(samples),
+      "avg": round(sum(samples) / len(samples), 3),
+      "p50": round(samples[int(len(samples) * 0.5)], 3),
+      "p95": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+      "max": round(samples[-1], 3),
+    }
+
+class SSHConnection:
+  def __init__(self, hostname, username, password, port, max_channels):
+    self.hostname = hostname
+    self.username = username
+    self.password = password
+    self.port = port
+    self.client = None
+    self.lock = threading.Lock()
+    self.channels = threading.BoundedSemaphore(max_channels)
+    self.active = 0
+    self.retired = False
+    self.last_used = time.time()
+
+  def is_alive(self):
+    return self.client is not None and self.client.get_transport() is not None and self.client.get_transport().is_active()
+
+  def get_transport(self, conf):
+    with self.lock:
+      if not self.is_alive():
+        reconnect = self.client is not None
+        self.close()
+        client = SSHClient()
+        client.set_missing_host_key_policy(AutoAddPolicy())
+        client.connect(hostname=self.hostname, port=self.port, username=self.username, password=self.password,
+          timeout=conf["CONNECT_TIMEOUT"])
+        client.get_transport().set_keepalive(conf["KEEPALIVE"])
+        self.client = client
+        SSHUtil._count("handshakes")
+        if reconnect:
+          SSHUtil._count("reconnects")
+      return self.client.get_transport()
+
+  def close(self):
+    if self.client is not None:
+      try:
+        self.client.close()
+      except Exception:
+        pass
+      self.client = None
+
 class SSHUtil:
+  default_conf = {
+    "PORT": 22,
+    "MAX_CHANNELS": 8,
+    "KEEPALIVE": 30,
+    "IDLE_TIMEOUT": 300,
+    "CONNECT_TIMEOUT": 10,
+    "COMMAND_TIMEOUT": 1800,
+    "MAX_OUTPUT_BYTES": 1024 * 1024,
+    "CHUNK_SIZE": 32768,
+    "POLL_INTERVAL": 0.1,
+  }
+  pid_marker = b"keeper-pid:"
+  pool = {}
+  lock = threading.Lock()
+  counters = {"handshakes": 0, "reconnects": 0, "evictions": 0, "channels": 0, "timeouts": 0, "cancelled": 0}
+  channel_wait = LatencyStats()
+  command_latency = LatencyStats()
+
+  @classmethod
+  def get_conf(cls):
+    conf = dict(cls.default_conf)
+    conf.update(get_optional_info("SSH_CONF", {}))
+    return conf
+
   @classmethod
-  def _get_ssh_client(cls, custom_conf=None):
-    cls.client = SSHClient()
-    cls.client.set_missing_host_key_policy(AutoAddPolicy())
-    hostname=get_info('HOST')
-    username=get_info('USERNAME')
-    password=get_info('PASSWORD')
+  def _get_connection(cls, conf, custom_conf=None):
     if custom_conf:
       hostname=custom_conf["HOST"]
       username=custom_conf["USERNAME"]
       password=custom_conf["PASSWORD"]
-    cls.client.connect(hostname=hostname, username=username, password=password)
-      
+      port=custom_conf.get("PORT", conf["PORT"])
+    else:
+      hostname=get_info('HOST')
+      username=get_info('USERNAME')
+      password=get_info('PASSWORD')
+      port=conf["PORT"]
+    key = (hostname, port, username)
+    with cls.lock:
+      cls._evict_idle(conf)
+      if key in cls.pool and cls.pool[key].password != password:
+        # Commands still running on the old connection keep it until they are done.
+        cls.pool[key].retired = True
+        if cls.pool[key].active == 0:
+          cls.pool[key].close()
+        del cls.pool[key]
+      if key not in cls.pool:
+        cls.pool[key] = SSHConnection(hostname, username, password, port, conf["MAX_CHANNELS"])
+      # Counted under the pool lock so the connection cannot be evicted before it is used.
+      cls.pool[key].active += 1
+      return cls.pool[key]
+
+  @classmethod
+  def _evict_idle(cls, conf):
+    deadline = time.time() - conf["IDLE_TIMEOUT"]
+    for key, conn in list(cls.pool.items()):
+      if conn.active == 0 and conn.last_used < deadline:
+        conn.close()
+        del cls.pool[key]
+        cls.counters["evictions"] += 1
+
   @classmethod
-  def exec_script(cls, app, filepath, *args, custom_conf=None):
+  @contextmanager
+  def lease(cls, conf, custom_conf=None):
+    conn = cls._get_connection(conf, custom_conf=custom_conf)
     try:
-      cls._get_ssh_client(custom_conf=custom_conf)
-      app.logger.debug('{} {}'.format(filepath, ' '.join(args)))
-      if custom_conf and "SCRIPT_PATH" in custom_conf:
-        filepath = path.join(custom_conf["SCRIPT_PATH"], filepath)
-      _, stdout, _ = cls.client.exec_command('{} {}'.format(filepath, ' '.join(args)))
-      return stdout.read().decode("utf-8")
-    except Exception as e:
-      app.logger.error("Failed to execute script: %s with error: %s", "{} {}".format(filepath, *args), e)
+      started_at = time.time()
+      conn.channels.acquire()
+      cls.channel_wait.add(time.time() - started_at)
+      try:
+        yield conn
+      finally:
+        conn.channels.release()
     finally:
-      if cls.client:
-        cls.client.close()
- 
+      with cls.lock:
+        conn.active -= 1
+        conn.last_used = time.time()
+        if conn.retired and conn.active == 0:
+          conn.close()
+
+  @classmethod
+  @contextmanager
+  def session(cls, custom_conf=None):
+    conf = cls.get_conf()
+    with cls.lease(conf, custom_conf=custom_conf) as conn:
+      yield conn.get_transport(conf)
+
+  @classmethod
+  def open_channel(cls, conn, conf):
+    transport = conn.get_transport(conf)
+    try:
+      channel = transport.open_session()
+    except Exception:
+      # A session refused by a live transport (MaxSessions, administratively prohibited) must not
+      # tear down the commands sharing it, only a transport dropped by the remote end is reconnected.
+      if transport.is_active():
+        raise
+      channel = conn.get_transport(conf).open_session()
+    cls._count("channels")
+    return channel
+
   @classmethod
-  def secure_copyfile(cls, app, src, dest):
+  def run(cls, app, command, custom_conf=None, timeout=None, cancel_event=None, callback=None, max_bytes=None):
+    conf = cls.get_conf()
+    if timeout is None:
+      timeout = conf["COMMAND_TIMEOUT"]
+    if max_bytes is None:
+      max_bytes = conf["MAX_OUTPUT_BYTES"]
+    buffers = {"stdout": TraceBuffer(max_bytes), "stderr": TraceBuffer(max_bytes)}
+    pending = {"stdout": b"", "stderr": b""}
+    header = {"pid": None, "data": b""}
+    def emit(stream, data):
+      if stream == "stderr" and header["pid"] is None:
+        # The first stderr line carries the remote process ID, it is not output of the command.
+        header["data"] += data
+        if b"\n" not in header["data"]:
+          return
+        line, rest = header["data"].split(b"\n", 1)
+        if line.startswith(cls.pid_marker) and line[len(cls.pid_marker):].isdigit():
+          header["pid"], data = int(line[len(cls.pid_marker):]), rest
+        else:
+          header["pid"], data = 0, header["data"]
+        if not data:
+          return
+      buffers[stream].append(data)
+      if callback:
+        callback(stream, data.decode("utf-8", errors="replace"))
+      lines = (pending[stream] + data).split(b"\n")
+      pending[stream] = lines.pop()
+      for line in lines:
+        app.logger.debug("[%s] %s", stream, line.decode("utf-8", errors="replace").rstrip())
+    started_at = time.time()
+    deadline = started_at + timeout if timeout and timeout > 0 else None
+    exit_code = None
+    timed_out = False
+    cancelled = False
+    with cls.lease(conf, custom_conf=custom_conf) as conn:
+      channel = cls.open_channel(conn, conf)
+      try:
+        channel.exec_command("echo %s$$ >&2; %s" % (cls.pid_marker.decode(), command))
+        while True:
+          # Checked on every pass so a command that keeps printing still times out.
+          if cancel_event is not None and cancel_event.is_set():
+            cancelled = True
+            break
+          if deadline is not None and time.time() >= deadline:
+            timed_out = True
+            break
+          # Both streams are drained on every pass so a chatty stdout cannot starve stderr.
+          received = False
+          if channel.recv_ready():
+            emit("stdout", channel.recv(conf["CHUNK_SIZE"]))
+            received = True
+          if channel.recv_stderr_ready():
+            emit("stderr", channel.recv_stderr(conf["CHUNK_SIZE"]))
+            received = True
+          if received:
+            continue
+          if channel.exit_status_ready():
+            exit_code = channel.recv_exit_status()
+            break
+          elif cancel_event is not None:
+            cancel_event.wait(conf["POLL_INTERVAL"])
+          else:
+            time.sleep(conf["POLL_INTERVAL"])
+      finally:
+        channel.close()
+      # Without a pty closing the channel does not stop the remote command, so it is killed.
+      if (timed_out or cancelled) and header["pid"]:
+        cls.kill(app, conn, conf, header["pid"])
+    for stream, data in pending.items():
+      if data:
+        app.logger.debug("[%s] %s", stream, data.decode("utf-8", errors="replace").rstrip())
+    result = CommandResult(command, exit_code, buffers["stdout"].text(), buffers["stderr"].text(),
+      truncated=buffers["stdout"].truncated or buffers["stderr"].truncated,
+      timed_out=timed_out, cancelled=cancelled, duration=time.time() - started_at)
+    cls.command_latency.add(result.duration)
+    if timed_out:
+      cls._count("timeouts")
+    if cancelled:
+      cls._count("cancelled")
+    return result
+
+  @classmethod
+  def kill(cls, app, conn, conf, pid):
+    # sshd starts commands without a pty as session leaders, so the whole process group is signalled.
+    try:
+      channel = cls.open_channel(conn, conf)
+      try:
+        channel.exec_command("kill -TERM -- -%d" % (pid,))
+        deadline = time.time() + conf["CONNECT_TIMEOUT"]
+        while not channel.exit_status_ready() and time.time() < deadline:
+          time.sleep(conf["POLL_INTERVAL"])
+      finally:
+        channel.close()
+      app.logger.debug("Killed remote process group: %d", pid)
+    except Exception as e:
+      app.logger.error("Failed to kill remote process group: %d with error: %s", pid, e)
+
+  @classmethod
+  def exec_script(cls, app, filepath, *args, custom_conf=None, timeout=None, cancel_event=None, callback=None):
+    from keeper.manager import KeeperException
+    app.logger.debug('{} {}'.format(filepath, ' '.join(args)))
+    if custom_conf and "SCRIPT_PATH" in custom_conf:
+      filepath = path.join(custom_conf["SCRIPT_PATH"], filepath)
+    command = '{} {}'.format(filepath, ' '.join(args))
+    try:
+      result = cls.run(app, command, custom_conf=custom_conf, timeout=timeout, cancel_event=cancel_event, callback=callback)
+    except Exception as e:
+      app.logger.error("Failed to execute script: %s with error: %s", command, e)
+      raise KeeperException(500, "Failed to execute script: %s with error: %s" % (command, e))
+    if not result.ok:
+      app.logger.error("%s, stderr: %s", result, result.stderr)
+      raise KeeperException(500, "%s, stderr: %s" % (result, result.stderr))
+    return result.stdout
+
+  @classmethod
+  def secure_copyfile(cls, app, src, dest, custom_conf=None):
     try:
-      cls._get_ssh_client()
-      with SCPClient(cls.client.get_transport()) as scp:
-        scp.put(src, remote_path=dest)
+      with cls.session(custom_conf=custom_conf) as transport:
+        with SCPClient(transport) as scp:
+          scp.put(src, remote_path=dest)
     except Exception as e:
       app.logger.error("Failed to execute secure copyfile with error: %s", e)
 
   @classmethod
   def secure_copy(cls, app, src, dest):
     try:
-      cls._get_ssh_client()
-      with SCPClient(cls.client.get_transport()) as scp:
-        for root, dirs, files in os.walk(src, topdown=True):
-          for dir in dirs:
-            scp.put(os.path.join(root, dir), remote_path=dest, recursive=True)
-            for file in files:
-              scp.put(os.path.join(root, file), remote_path=dest)
+      with cls.session() as transport:
+        with SCPClient(transport) as scp:
+          for root, dirs, files in os.walk(src, topdown=True):
+            for dir in dirs:
+              scp.put(os.path.join(root, dir), remote_path=dest, recursive=True)
+              for file in files:
+                scp.put(os.path.join(root, file), remote_path=dest)
     except Exception as e:
       app.logger.error("Failed to execute secure copy with error: %s", e)
 
+  @classmethod
+  def _count(cls, name):
+    with cls.lock:
+      cls.counters[name] += 1
+
+  @classmethod
+  def stats(cls):
+    with cls.lock:
+      counters = dict(cls.counters)
+      connections = {"%s@%s:%d" % (key[2], key[0], key[1]): {"active": conn.active, "alive": conn.is_alive()} for key, conn in cls.pool.items()}
+    return dict(counters, connections=connections, channel_wait=cls.channel_wait.summary(),
+      command_latency=cls.command_latency.summary())
+
 class TemplateUtil:
   @classmethod
   def _get_template(cls, template_name):
@@ -94,4 +362,45 @@ class SubTaskUtil:
   
   @classmethod
   def start(cls):
-    Thread(target=SubTaskUtil.subtask).start()
\ No newline at end of file
+    Thread(target=SubTaskUtil.subtask).start()
+
+class ConcurrentUtil:
+
+  @classmethod
+  def map(cls, app, callback, items, max_workers=4):
+    current = app._get_current_object() if hasattr(app, "_get_current_object") else app
+    def run(item):
+      with current.app_context():
+        return callback(item)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+      return list(executor.map(run, items))
+
+class TraceBuffer:
+  def __init__(self, max_bytes=0, keep_tail=True):
+    self.max_bytes = max_bytes
+    self.keep_tail = keep_tail
+    self.chunks = deque()
+    self.size = 0
+    self.truncated = False
+
+  def append(self, chunk):
+    if self.max_bytes > 0 and not self.keep_tail:
+      remaining = self.max_bytes - self.size
+      if len(chunk) > remaining:
+        chunk = chunk[:remaining]
+        self.truncated = True
+    self.chunks.append(chunk)
+    self.size += len(chunk)
+    while self.max_bytes > 0 and self.size > self.max_bytes:
+      head = self.chunks.popleft()
+      excess = self.size - self.max_bytes
+      if len(head) > excess:
+        self.chunks.appendleft(head[excess:])
+        self.size -= excess
+      else:
+        self.size -= len(head)
+      self.truncated = True
+    return not (self.truncated and not self.keep_tail)
+
+  def text(self):
+    return b"".join(self.chunks).decode("utf-8", errors="replace")
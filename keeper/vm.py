@@ -2,14 +2,25 @@ from flask import (
   Blueprint, request,  jsonify, current_app, abort, Response, url_for
 )
 
-from keeper.db import get_vm
+from keeper.db import get_vm, get_vm_inventory
 from keeper.manager import KeeperManager, KeeperException
 from keeper.util import SubTaskUtil
-from keeper.model import VM, Snapshot
+from keeper.model import VM, Snapshot, VMRequest
+from keeper.dispatch import Dispatcher
+from keeper.warmpool import WarmPool
+from keeper.status import GlobalStatusPoller
+from keeper.hosts import HostRegistry
+
+import time
 
 bp = Blueprint('vm', __name__, url_prefix="/api/v1")
 
 def recycle_vm(current_app, vm_name, project_id, pipeline_id, status="N/A"):
+  if WarmPool.restore(vm_name, current_app):
+    return
+  destroy_vm(current_app, vm_name, project_id, pipeline_id, status)
+
+def destroy_vm(current_app, vm_name, project_id, pipeline_id, status="N/A"):
   try:
     KeeperManager(current_app, vm_name).force_delete_vm()
   except KeeperException as e:
@@ -17,6 +28,71 @@ def recycle_vm(current_app, vm_name, project_id, pipeline_id, status="N/A"):
   finally:
     KeeperManager.release_ip_runner_on_success(pipeline_id, status, current_app)
     KeeperManager.unregister_runner_by_name(vm_name, current_app)
+    WarmPool.forget(vm_name, current_app)
+
+def provision_vm(current_app, vm_request):
+  started_at = time.time()
+  vm_name = vm_request.vm_name
+  project_id = vm_request.project_id
+  KeeperManager.unregister_inrelevant_runner(project_id, vm_name, current_app)
+  manager = KeeperManager(current_app, vm_name)
+  if manager.check_vm_exists():
+    # Restoring a snapshot here would leave a VM in the directory create_vm is about to use.
+    destroy_vm(current_app, vm_name, project_id, vm_request.pipeline_id)
+  manager.place_vm(vm_request.vm_conf)
+  runner_token = KeeperManager.resolve_runner_token(vm_request.username, vm_request.project_name, current_app)
+  snapshot_mode = WarmPool.is_snapshot_mode()
+  # In snapshot mode the VM boots without a runner so that its clean snapshot can be reused.
+  manager.generate_vagrantfile(None if snapshot_mode else runner_token, vm_request.vm_conf)
+  manager.copy_vm_files()
+  current_app.logger.debug(manager.create_vm())
+  if snapshot_mode:
+    WarmPool.adopt(manager, vm_request, current_app)
+    current_app.logger.debug(manager.register_runner_in_vm(runner_token, vm_request.vm_conf["runner_tag"]))
+  message = bind_vm_runner(current_app, manager, vm_request)
+  WarmPool.record_time_to_runner(time.time() - started_at, warm=False)
+  return message
+
+def provision_warm_vm(current_app, vm_request):
+  started_at = time.time()
+  KeeperManager.unregister_inrelevant_runner(vm_request.project_id, vm_request.vm_name, current_app)
+  manager = KeeperManager(current_app, vm_request.vm_name)
+  runner_token = KeeperManager.resolve_runner_token(vm_request.username, vm_request.project_name, current_app)
+  current_app.logger.debug(manager.register_runner_in_vm(runner_token, vm_request.vm_conf["runner_tag"]))
+  message = bind_vm_runner(current_app, manager, vm_request)
+  WarmPool.record_time_to_runner(time.time() - started_at, warm=True)
+  return message
+
+def bind_vm_runner(current_app, manager, vm_request):
+  vm_name = vm_request.vm_name
+  username = vm_request.username
+  project_id = vm_request.project_id
+  project_name = vm_request.project_name
+  pipeline_id = vm_request.pipeline_id
+  ip_provision_id = vm_request.ip_provision_id
+  power_status = KeeperManager.get_runner_power_status(project_id, current_app)
+  cancel_type = KeeperManager.get_runner_cancel_status(project_id, current_app)
+  if KeeperManager.canceled_by_user == cancel_type and KeeperManager.powering_on == power_status:
+    message = "VM: %s would be recycled as it has been signaled to cancel by user." % (vm_name,)
+    current_app.logger.debug(message)
+    recycle_vm(current_app, vm_name, project_id, pipeline_id)
+    return message
+  KeeperManager.update_runner_power_status(username, project_name, ip_provision_id, KeeperManager.powered_on, current_app)
+  try:
+    info = manager.get_vm_info()
+    vm = VM(vm_id=info.id, vm_name=vm_name, target="AUTOMATED", keeper_url="N/A")
+    runner = KeeperManager.register_project_runner(username, project_name, vm_name, vm, snapshot=None, app=current_app)
+    KeeperManager.update_ip_runner(ip_provision_id, runner.runner_id, current_app)
+  except KeeperException as e0:
+    current_app.logger.error("Failed to get runner: %s", e0)
+  finally:
+    KeeperManager.update_runner_power_status(username, project_name, ip_provision_id, KeeperManager.powered_on_using, current_app)
+  return "VM: %s has been created." % (vm_name,)
+
+@bp.before_app_request
+def start_warm_pool():
+  WarmPool.ensure_started(current_app._get_current_object())
+  GlobalStatusPoller.ensure_started(current_app._get_current_object())
 
 @bp.route('/vm/simple', methods=["POST"])
 def vm_simple():
@@ -83,38 +159,58 @@ def vm():
     if 'runner_tag' not in vm_conf:
       return abort(400, 'Runner tag is required.')
     try:
-      current = current_app._get_current_object()
-      def callback():
-        KeeperManager.unregister_inrelevant_runner(project_id, vm_name, current)
-        manager = KeeperManager(current, vm_name)
-        if manager.check_vm_exists():
-          recycle_vm(current, vm_name, project_id, pipeline_id)
-        runner_token = KeeperManager.resolve_runner_token(username, project_name, current)
-        manager.generate_vagrantfile(runner_token, vm_conf)
-        manager.copy_vm_files()
-        current.logger.debug(manager.create_vm())
-        power_status = KeeperManager.get_runner_power_status(project_id, current)
-        cancel_type = KeeperManager.get_runner_cancel_status(project_id, current)
-        if KeeperManager.canceled_by_user == cancel_type and KeeperManager.powering_on == power_status:
-          message = "VM: %s would be recycled as it has been signaled to cancel by user." % (vm_name,)
-          current.logger.debug(message)
-          recycle_vm(current, vm_name, project_id, pipeline_id)
-          return jsonify(message=message)
-        KeeperManager.update_runner_power_status(username, project_name, ip_provision_id, KeeperManager.powered_on, current)
-        try:
-          info = manager.get_vm_info()
-          vm = VM(vm_id=info.id, vm_name=vm_name, target="AUTOMATED", keeper_url="N/A")
-          runner = KeeperManager.register_project_runner(username, project_name, vm_name, vm, snapshot=None, app=current)
-          KeeperManager.update_ip_runner(ip_provision_id, runner.runner_id, current)
-        except KeeperException as e0:
-          current.logger.error("Failed to get runner: %s", e0)
-        finally:
-          KeeperManager.update_runner_power_status(username, project_name, ip_provision_id, KeeperManager.powered_on_using, current)
-      SubTaskUtil.set(current_app, callback).start()
+      vm_request = VMRequest(vm_name, username, project_id, project_name, status, ip_provision_id, pipeline_id, vm_conf)
+      Dispatcher.submit_to(Dispatcher.provision_pool, current_app, provision_vm, current_app._get_current_object(), vm_request)
       return jsonify(message="VM: %s has being created." % vm_name)
     except KeeperException as e:
       return abort(e.code, e.message)
 
+@bp.route("/vm/inventory", methods=["GET"])
+def vm_inventory():
+  filters = {}
+  for arg, key in (("project_id", "project_id"), ("power_status", "power_status"), ("cancel_status", "cancel_status")):
+    value = request.args.get(arg, None)
+    if value is not None:
+      try:
+        filters[key] = int(value)
+      except ValueError:
+        return abort(400, "%s must be an integer." % (arg,))
+  host_name = request.args.get("host", None)
+  if host_name is not None and host_name not in HostRegistry.get_hosts():
+    return abort(400, "Unknown host: %s." % (host_name,))
+  try:
+    page = max(1, int(request.args.get("page", 1)))
+    per_page = min(500, max(1, int(request.args.get("per_page", 50))))
+  except ValueError:
+    return abort(400, "Page and per page must be integers.")
+  rows = get_vm_inventory(host_name=host_name, limit=per_page, offset=(page - 1) * per_page, **filters)
+  statuses = GlobalStatusPoller.get_all(current_app, host_name=host_name)
+  warm_statuses = {WarmPool.booting: "booting", WarmPool.ready: "ready", WarmPool.assigned: "assigned"}
+  vms = []
+  for r in rows:
+    _, status = statuses.get(r["vm_dir"], (None, None))
+    vms.append({
+      "vm_id": r["vm_id"],
+      "vm_name": r["vm_name"],
+      "vm_dir": r["vm_dir"],
+      "target": r["target"],
+      "project_id": r["project_id"],
+      "project_name": r["project_name"],
+      "runner_id": r["runner_id"],
+      "runner_name": r["runner_name"],
+      "pipeline_id": r["pipeline_id"],
+      "power_status": r["is_power_on"],
+      "cancel_status": r["is_canceled"],
+      "ip_address": r["ip_address"],
+      "host": r["host_name"],
+      "vm_memory": r["vm_memory"],
+      "warm_status": warm_statuses.get(r["warm_status"]),
+      "vm_status": status.status if status else None,
+      "vm_provider": status.provider if status else None,
+    })
+  total = rows[0]["total"] if rows else (0 if page == 1 else None)
+  return jsonify(page=page, per_page=per_page, total=total, vms=vms)
+
 @bp.route("/vm/info/<path:vm_name>", methods=["GET", "DELETE"])
 def vm_info(vm_name):
   if vm_name is None:
@@ -130,8 +226,10 @@ def vm_info(vm_name):
       if not project_name:
         return abort(400, "Project name is required.")
       def callback():
-        manager.force_delete_vm()
-        manager.unregister_runner_by_name(vm_name, current_app)
+        try:
+          manager.force_delete_vm()
+        finally:
+          manager.unregister_runner_by_name(vm_name, current_app)
       SubTaskUtil.set(current_app, callback).start()
       return jsonify(message="VM: %s is being deleted." % vm_name)
   except KeeperException as e:
@@ -0,0 +1,254 @@
+import threading
+import time
+import uuid
+
+from keeper import db
+from keeper import get_info, get_optional_info
+from keeper.manager import KeeperManager, KeeperException
+from keeper.hosts import HostRegistry
+from keeper.util import LatencyStats
+
+class WarmPool:
+  booting = 0
+  ready = 1
+  assigned = 2
+  default_conf = {
+    "SIZE": 0,
+    "MEMORY_BUDGET": 0,
+    "PROFILES": [],
+    "REFILL_INTERVAL": 60,
+    "NAME_PREFIX": "warm",
+    "SNAPSHOT_NAME": "clean",
+    "MAX_IDLE": 0,
+  }
+  condition = threading.Condition()
+  thread = None
+  counters = {"hits": 0, "misses": 0, "booted": 0, "boot_failures": 0, "adopted": 0, "restored": 0, "restore_failures": 0, "trimmed": 0}
+  warm_time_to_runner = LatencyStats()
+  cold_time_to_runner = LatencyStats()
+  boot_latency = LatencyStats()
+  restore_latency = LatencyStats()
+
+  @classmethod
+  def get_conf(cls):
+    conf = dict(cls.default_conf)
+    conf.update(get_optional_info("WARM_POOL_CONF", {}))
+    return conf
+
+  @classmethod
+  def get_profiles(cls, conf):
+    if conf["PROFILES"]:
+      return [(p["VM_BOX"], int(p["VM_MEMORY"]), p.get("SIZE", conf["SIZE"])) for p in conf["PROFILES"]]
+    vm_conf = get_info("VM_CONF")
+    return [(vm_conf["VM_BOX"], int(vm_conf["VM_MEMORY"]), conf["SIZE"])]
+
+  @classmethod
+  def is_enabled(cls, conf):
+    return cls.is_snapshot_mode() or any(size > 0 for _, _, size in cls.get_profiles(conf))
+
+  @classmethod
+  def is_snapshot_mode(cls):
+    return get_optional_info("PROVISION_MODE", "rebuild") == "snapshot"
+
+  @classmethod
+  def acquire(cls, project_id, pipeline_id, vm_name, vm_box, vm_memory, app):
+    if not cls.is_enabled(cls.get_conf()):
+      return None
+    r, warm_vm = db.assign_warm_vm(vm_box, int(vm_memory), project_id, pipeline_id, vm_name, time.time(), app)
+    if r:
+      if r["is_canceled"] == KeeperManager.canceled_by_user:
+        raise KeeperException(412, "Runner to the project ID: %s has been signaled to cancel, please wait for it to recycle." % (project_id,))
+      raise KeeperException(409, "IP runner already reserved.")
+    cls._count("hits" if warm_vm else "misses")
+    cls.wakeup()
+    if warm_vm:
+      app.logger.debug("Assigned warm VM: %s with IP: %s to %s.", warm_vm["vm_dir"], warm_vm["ip_address"], vm_name)
+    return warm_vm
+
+  @classmethod
+  def forget(cls, vm_name, app):
+    db.remove_warm_vm_by_alias(vm_name, app)
+
+  @classmethod
+  def adopt(cls, manager, vm_request, app):
+    snapshot_name = cls.get_conf()["SNAPSHOT_NAME"]
+    app.logger.debug(manager.save_snapshot(snapshot_name))
+    vm_conf = vm_request.vm_conf
+    db.adopt_warm_vm(manager.vm_name, vm_conf["vm_box"], int(vm_conf["vm_memory"]), vm_request.ip_provision_id,
+      manager.vm_name, vm_request.pipeline_id, snapshot_name, time.time(), app)
+    cls._count("adopted")
+
+  @classmethod
+  def restore(cls, vm_name, app):
+    if not cls.is_snapshot_mode():
+      return False
+    warm_vm = db.get_warm_vm_by_alias(vm_name)
+    if not warm_vm or not warm_vm["snapshot_name"]:
+      return False
+    started_at = time.time()
+    manager = KeeperManager(app, vm_name)
+    unregistered = False
+    try:
+      # The runner of the finished pipeline goes first, the VM is only ready again once restored and clean.
+      KeeperManager.unregister_runner_by_name(vm_name, app, strict=True)
+      unregistered = True
+      app.logger.debug(manager.restore_snapshot(warm_vm["snapshot_name"]))
+      if not manager.check_runner_health():
+        raise KeeperException(500, "Runner service of VM: %s is not healthy after restore." % (warm_vm["vm_dir"],))
+      db.return_warm_vm(vm_name, time.time(), app)
+      cls.restore_latency.add(time.time() - started_at)
+      cls._count("restored")
+      app.logger.debug("VM: %s was restored to snapshot: %s and returned to warm pool.", warm_vm["vm_dir"], warm_vm["snapshot_name"])
+    except Exception as e:
+      app.logger.error("Failed to restore VM: %s, will destroy it instead: %s", warm_vm["vm_dir"], e)
+      cls._count("restore_failures")
+      try:
+        manager.force_delete_vm()
+      except KeeperException as ke:
+        app.logger.error(ke.message)
+      finally:
+        db.discard_warm_vm_by_alias(vm_name, app)
+        if not unregistered:
+          KeeperManager.unregister_runner_by_name(vm_name, app)
+    KeeperManager.notify_capacity_released("VM: %s recycled" % (vm_name,), app)
+    cls.wakeup()
+    return True
+
+  @classmethod
+  def record_time_to_runner(cls, seconds, warm):
+    (cls.warm_time_to_runner if warm else cls.cold_time_to_runner).add(seconds)
+
+  @classmethod
+  def wakeup(cls):
+    with cls.condition:
+      cls.condition.notify()
+
+  @classmethod
+  def ensure_started(cls, app):
+    with cls.condition:
+      if cls.thread is not None and cls.thread.is_alive():
+        return
+      cls.thread = threading.Thread(target=cls.run, args=(app,), name="warm-pool", daemon=True)
+      cls.thread.start()
+
+  @classmethod
+  def run(cls, app):
+    while True:
+      with app.app_context():
+        conf = cls.get_conf()
+        try:
+          if cls.is_enabled(conf):
+            cls.refill(app, conf)
+        except Exception as e:
+          app.logger.error("Failed to refill warm pool: %s", e)
+      with cls.condition:
+        cls.condition.wait(conf["REFILL_INTERVAL"])
+
+  @classmethod
+  def trim(cls, app, conf):
+    idle = sorted([r for r in db.get_warm_vms() if r["status"] == cls.ready], key=lambda r: r["ready_at"])
+    memory = sum(r["vm_memory"] for r in db.get_warm_vms() if r["status"] != cls.assigned)
+    for r in idle:
+      over_budget = conf["MEMORY_BUDGET"] > 0 and memory > conf["MEMORY_BUDGET"]
+      over_size = conf["MAX_IDLE"] > 0 and len(idle) > conf["MAX_IDLE"]
+      if not over_budget and not over_size:
+        break
+      app.logger.debug("Trim warm VM: %s from warm pool.", r["vm_dir"])
+      manager = KeeperManager(app, r["vm_dir"])
+      try:
+        manager.force_delete_vm()
+      except KeeperException as e:
+        app.logger.error(e.message)
+      db.release_warm_vm(r["vm_dir"], app)
+      idle = idle[1:]
+      memory -= r["vm_memory"]
+      cls._count("trimmed")
+
+  @classmethod
+  def refill(cls, app, conf):
+    cls.trim(app, conf)
+    while True:
+      idle = [r for r in db.get_warm_vms() if r["status"] != cls.assigned]
+      memory = sum(r["vm_memory"] for r in idle)
+      booted = False
+      for vm_box, vm_memory, size in cls.get_profiles(conf):
+        count = len([r for r in idle if r["vm_box"] == vm_box and r["vm_memory"] == vm_memory])
+        if count >= size:
+          continue
+        if conf["MEMORY_BUDGET"] > 0 and memory + vm_memory > conf["MEMORY_BUDGET"]:
+          app.logger.debug("Warm pool memory budget: %d MB reached, skip profile: %s/%d.", conf["MEMORY_BUDGET"], vm_box, vm_memory)
+          continue
+        if not cls.boot(vm_box, vm_memory, app, conf):
+          return
+        booted = True
+        break
+      if not booted:
+        return
+
+  @classmethod
+  def boot(cls, vm_box, vm_memory, app, conf):
+    vm_dir = "%s-%s" % (conf["NAME_PREFIX"], uuid.uuid4().hex[:12])
+    ip = db.claim_warm_vm_ip(vm_dir, vm_box, vm_memory, time.time(), app, rank=HostRegistry.get_ranker(vm_memory, app))
+    if not ip:
+      app.logger.debug("IP provision pool exhausted, warm pool will not be refilled.")
+      return False
+    started_at = time.time()
+    manager = KeeperManager(app, vm_dir)
+    try:
+      vm_conf = {
+        "vm_box": vm_box,
+        "vm_memory": vm_memory,
+        "vm_ip": ip["ip_address"],
+        "runner_tag": "",
+      }
+      manager.place_vm(vm_conf)
+      manager.generate_vagrantfile(None, vm_conf)
+      manager.copy_vm_files()
+      app.logger.debug(manager.create_vm())
+      if not manager.check_vm_exists():
+        raise KeeperException(500, "Warm VM: %s was not created." % (vm_dir,))
+      snapshot_name = None
+      if cls.is_snapshot_mode():
+        snapshot_name = conf["SNAPSHOT_NAME"]
+        app.logger.debug(manager.save_snapshot(snapshot_name))
+      db.update_warm_vm_ready(vm_dir, time.time(), snapshot_name, app)
+      cls.boot_latency.add(time.time() - started_at)
+      cls._count("booted")
+      app.logger.debug("Warm VM: %s with IP: %s is ready.", vm_dir, ip["ip_address"])
+      return True
+    except Exception as e:
+      app.logger.error("Failed to boot warm VM: %s, %s", vm_dir, e)
+      cls._count("boot_failures")
+      try:
+        if manager.check_vm_exists():
+          manager.force_delete_vm()
+        else:
+          manager.remove_vm_files()
+      except KeeperException as ke:
+        app.logger.error(ke.message)
+      finally:
+        db.remove_vm_host(vm_dir, app)
+        db.release_warm_vm(vm_dir, app)
+      return False
+
+  @classmethod
+  def _count(cls, name):
+    with cls.condition:
+      cls.counters[name] += 1
+
+  @classmethod
+  def stats(cls):
+    statuses = {cls.booting: "booting", cls.ready: "ready", cls.assigned: "assigned"}
+    vms = {name: 0 for name in statuses.values()}
+    for r in db.get_warm_vms():
+      vms[statuses[r["status"]]] += 1
+    with cls.condition:
+      counters = dict(cls.counters)
+    requests = counters["hits"] + counters["misses"]
+    return dict(counters, vms=vms,
+      hit_rate=round(counters["hits"] / requests, 3) if requests else 0,
+      warm_time_to_runner=cls.warm_time_to_runner.summary(),
+      cold_time_to_runner=cls.cold_time_to_runner.summary(),
+      boot_latency=cls.boot_latency.summary(),
+      restore_latency=cls.restore_latency.summary(),
+      provision_mode=get_optional_info("PROVISION_MODE", "rebuild"))
@@ -0,0 +1,180 @@
+from flask import (
+  Blueprint, request, jsonify, current_app, url_for, abort, make_response
+)
+from werkzeug.exceptions import HTTPException
+
+import json
+import threading
+import time
+import uuid
+
+from keeper import db
+from keeper import get_optional_info
+from keeper.util import LatencyStats
+
+bp = Blueprint("webhook", __name__, url_prefix="/api/v1")
+
+class WebhookKind:
+  def __init__(self, endpoint, args, fields):
+    self.endpoint = endpoint
+    self.args = args
+    self.fields = fields
+
+class WebhookQueue:
+  queued = 0
+  leased = 1
+  done = 2
+  failed = 3
+  kinds = {
+    "runners": WebhookKind("integration.prepare_runner", ["base_repo_name", "username"], ["project", "object_attributes"]),
+    "issues-open-peer": WebhookKind("integration.issue_open_peer", ["ref", "default_assignee"], ["project", "object_attributes", "labels"]),
+    "tag-release": WebhookKind("integration.tag_release", ["release_repo", "release_branch", "username"], ["object_kind", "project"]),
+    "merge-request-relate-issue": WebhookKind("integration.relate_issue_to_merge_request", [], ["project", "object_attributes"]),
+    "merge-request-pre-merge": WebhookKind("integration.legacy_pre_merge", ["token"], ["object_attributes", "user"]),
+  }
+  default_conf = {
+    "WORKERS": 2,
+    "LEASE_SECONDS": 600,
+    "MAX_ATTEMPTS": 5,
+    "POLL_INTERVAL": 2,
+    "RETENTION_SECONDS": 7 * 24 * 3600,
+  }
+  lock = threading.Lock()
+  wakeup = threading.Event()
+  workers = []
+  counters = {"accepted": 0, "processed": 0, "failed": 0, "retried": 0}
+  wait_latency = LatencyStats()
+  process_latency = LatencyStats()
+
+  @classmethod
+  def get_conf(cls):
+    conf = dict(cls.default_conf)
+    conf.update(get_optional_info("WEBHOOK_CONF", {}))
+    return conf
+
+  @classmethod
+  def enqueue(cls, endpoint, path, query_string, payload, app):
+    event_id = db.insert_webhook_event(endpoint, path, query_string, json.dumps(payload), time.time(), app)
+    cls._count("accepted")
+    cls.wakeup.set()
+    return event_id
+
+  @classmethod
+  def ensure_workers(cls, app):
+    with cls.lock:
+      cls.workers = [w for w in cls.workers if w.is_alive()]
+      with app.app_context():
+        size = cls.get_conf()["WORKERS"]
+      while len(cls.workers) < size:
+        worker = threading.Thread(target=cls.work, args=(app,), name="webhook-worker-%d" % len(cls.workers), daemon=True)
+        worker.start()
+        cls.workers.append(worker)
+
+  @classmethod
+  def work(cls, app):
+    while True:
+      with app.app_context():
+        conf = cls.get_conf()
+        try:
+          processed = cls.process_next(app, conf)
+        except Exception as e:
+          app.logger.error("Webhook worker failed to process queue: %s", e)
+          processed = False
+        if not processed:
+          cls.purge(app, conf)
+      if not processed:
+        cls.wakeup.wait(conf["POLL_INTERVAL"])
+        cls.wakeup.clear()
+
+  @classmethod
+  def process_next(cls, app, conf):
+    lease_token = uuid.uuid4().hex
+    now = time.time()
+    # An event whose worker died or hung past its lease never reaches the retry check below.
+    dead = db.fail_expired_webhook_events(now, conf["MAX_ATTEMPTS"], app)
+    if dead > 0:
+      app.logger.error("%d webhook events exhausted %d attempts without finishing.", dead, conf["MAX_ATTEMPTS"])
+      with cls.lock:
+        cls.counters["failed"] += dead
+    event = db.lease_webhook_event(lease_token, now, now + conf["LEASE_SECONDS"], app)
+    if event is None:
+      return False
+    cls.wait_latency.add(now - event["created_at"])
+    app.logger.debug("Leased webhook event: %d for %s with attempt: %d", event["id"], event["endpoint"], event["attempts"])
+    error = None
+    retryable = False
+    try:
+      with app.test_request_context(event["path"], method="POST", query_string=event["query_string"], json=json.loads(event["payload"])):
+        resp = make_response(app.view_functions[event["endpoint"]]())
+        if resp.status_code >= 500:
+          error, retryable = "Handler responded with status code: %d" % resp.status_code, True
+        elif resp.status_code >= 400:
+          error = "Handler responded with status code: %d" % resp.status_code
+    except HTTPException as e:
+      error, retryable = "%s: %s" % (e.code, e.description), e.code is None or e.code >= 500
+    except Exception as e:
+      error, retryable = repr(e), True
+    cls.process_latency.add(time.time() - now)
+    if error is None:
+      db.finish_webhook_event(event["id"], lease_token, cls.done, time.time(), None, app)
+      cls._count("processed")
+    elif retryable and event["attempts"] < conf["MAX_ATTEMPTS"]:
+      app.logger.warning("Webhook event: %d will be retried: %s", event["id"], error)
+      db.requeue_webhook_event(event["id"], lease_token, error, app)
+      cls._count("retried")
+    else:
+      app.logger.error("Webhook event: %d failed after %d attempts: %s", event["id"], event["attempts"], error)
+      db.finish_webhook_event(event["id"], lease_token, cls.failed, time.time(), error, app)
+      cls._count("failed")
+    return True
+
+  @classmethod
+  def purge(cls, app, conf):
+    db.delete_webhook_events_before(time.time() - conf["RETENTION_SECONDS"], app)
+
+  @classmethod
+  def _count(cls, name):
+    with cls.lock:
+      cls.counters[name] += 1
+
+  @classmethod
+  def stats(cls):
+    row = db.get_webhook_queue_stats()
+    oldest = row["oldest_created_at"]
+    with cls.lock:
+      counters = dict(cls.counters)
+      workers = len([w for w in cls.workers if w.is_alive()])
+    return dict(counters,
+      depth=row["queued"] or 0,
+      leased=row["leased"] or 0,
+      dead=row["failed"] or 0,
+      oldest_age=round(time.time() - oldest, 3) if oldest else 0,
+      workers=workers,
+      wait_latency=cls.wait_latency.summary(),
+      process_latency=cls.process_latency.summary())
+
+@bp.before_app_request
+def start_workers():
+  WebhookQueue.ensure_workers(current_app._get_current_object())
+
+@bp.route("/webhooks/<kind>", methods=["POST"])
+def receive(kind):
+  if kind not in WebhookQueue.kinds:
+    return abort(404, "Unknown webhook kind: %s." % (kind,))
+  webhook_kind = WebhookQueue.kinds[kind]
+  for arg in webhook_kind.args:
+    if not request.args.get(arg, None):
+      return abort(400, "Argument %s is required." % (arg,))
+  data = request.get_json(silent=True)
+  if not isinstance(data, dict):
+    return abort(400, "Webhook payload must be a JSON object.")
+  for field in webhook_kind.fields:
+    if field not in data:
+      return abort(400, "Missing %s in webhook payload." % (field,))
+  path = url_for(webhook_kind.endpoint)
+  event_id = WebhookQueue.enqueue(webhook_kind.endpoint, path, request.query_string.decode("utf-8"), data, current_app)
+  return make_response(jsonify(message="Webhook event: %d has been queued." % (event_id,), id=event_id), 202)
+
+@bp.route("/webhooks/stats")
+def queue_stats():
+  return jsonify(WebhookQueue.stats())